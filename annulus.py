@@ -5,7 +5,10 @@ import pyds9
 import ipdb
 import datetime
 from astropy.io import fits as pyfits
-from scipy.ndimage.filters import gaussian_filter
+from scipy.special import erf
+from collections import OrderedDict
+import multiprocessing
+import glob
 
 def model_annulus(pars, image, err, save=False):
     
@@ -37,32 +40,24 @@ def model_annulus(pars, image, err, save=False):
     if y_center < (ymin-3.0*sigma) or y_center > (ymax+3.0*sigma): return [np.Infinity]
 
     xgrid,ygrid = np.meshgrid(np.linspace(xmin-x_center, xmax-x_center, xlen), np.linspace(ymin-y_center, ymax-y_center, ylen))
-    xgridhole,ygridhole = np.meshgrid(np.linspace(xmin-x_hole, xmax-x_hole, xlen), np.linspace(ymin-y_hole, ymax-y_hole, ylen))
 
-    dhole = np.sqrt(xgridhole*xgridhole+ygridhole*ygridhole)
-    hole = np.where(dhole < hole_size)
-
-
-    hole_mask = np.zeros((ylen,xlen),dtype=np.float64) + 1.0
-
-    hole_mask[hole[0],hole[1]] = 0.0
-    hole_mask = gaussian_filter(hole_mask,sigma=1.0)
+    # the (blurred) hole is cached; see hole_mask
+    mask = hole_mask(image.shape, x_hole, y_hole, hole_size)
 
 
     mu = 0.0
     d = np.sqrt(xgrid*xgrid+ygrid*ygrid)
-    g = hole_mask*amplitude*np.exp(-( (d-mu)**2 / ( 2.0 * sigma**2 ) ) ) + background
+    g = mask*amplitude*np.exp(-( (d-mu)**2 / ( 2.0 * sigma**2 ) ) ) + background
 #    g = amplitude*np.exp(-( (d-mu)**2 / ( 2.0 * sigma**2 ) ) ) + background
 #    g[hole[0],hole[1]] = background
 
-    ds9=pyds9.DS9()
-    ds9.set_np2arr(g)
-#    ds9.set_np2arr(image)
-
 #    ipdb.set_trace()
 
-    save = True
+    # this is a diagnostic; fit_annulus uses annulus_grid, which does no I/O
     if save: 
+        ds9=pyds9.DS9()
+        ds9.set_np2arr(g)
+
         hdu = pyfits.PrimaryHDU(g)
         hdu.writeto('model.fits',overwrite=True)
 
@@ -72,7 +67,7 @@ def model_annulus(pars, image, err, save=False):
         hdu = pyfits.PrimaryHDU(image)
         hdu.writeto('image.fits',overwrite=True)
 
-    print(np.sum(((image - g)/err)**2), x_center, y_center, sigma, background, amplitude, x_hole, y_hole, hole_size) 
+        print(np.sum(((image - g)/err)**2), x_center, y_center, sigma, background, amplitude, x_hole, y_hole, hole_size) 
 #    ipdb.set_trace()
 
 #    return [np.sum(((image - g)/err)**2)]
@@ -80,9 +75,248 @@ def model_annulus(pars, image, err, save=False):
     return ((image - g)/err).flatten()
 
 
-def fit_annulus(image, pars=None, scale=None):
-
-    if pars==None:
+# anti-aliased masks of the fiber hole (0 in the hole, 1 outside), with
+# an erf edge of width edge pixels. Each pixel is averaged over
+# oversample x oversample sub-pixels. The hole barely moves during a night,
+# so masks are cached (least recently used are evicted beyond
+# HOLE_MASK_CACHE_SIZE), keyed on the hole parameters rounded to quantum
+# pixels. The returned mask is shared; do not modify it
+HOLE_MASK_CACHE_SIZE = 64
+_hole_masks = OrderedDict()
+def hole_mask(shape, x_hole, y_hole, hole_size, edge=1.0, oversample=4, quantum=0.01):
+
+    key = (tuple(shape), int(round(x_hole/quantum)), int(round(y_hole/quantum)),
+           int(round(hole_size/quantum)), edge, oversample, quantum)
+    if key in _hole_masks:
+        _hole_masks.move_to_end(key)
+        return _hole_masks[key]
+
+    # render at the quantized position so the cache is self consistent
+    x_hole = key[1]*quantum
+    y_hole = key[2]*quantum
+    hole_size = key[3]*quantum
+
+    ylen,xlen = shape
+    sub = (np.arange(oversample) + 0.5)/oversample - 0.5
+    x = (np.arange(1,xlen+1)[:,None] + sub[None,:]).ravel() - x_hole
+    y = (np.arange(1,ylen+1)[:,None] + sub[None,:]).ravel() - y_hole
+    d = np.hypot(y[:,None], x[None,:])
+    if edge > 0: mask = 0.5*(1.0 + erf((d - hole_size)/(np.sqrt(2.0)*edge)))
+    else: mask = (d >= hole_size).astype(np.float64)
+    mask = mask.reshape(ylen,oversample,xlen,oversample).mean(axis=(1,3))
+    mask.flags.writeable = False
+
+    _hole_masks[key] = mask
+    if len(_hole_masks) > HOLE_MASK_CACHE_SIZE:
+        _hole_masks.popitem(last=False)
+    return mask
+
+# the pixel grids and scratch buffers needed to evaluate the annulus model
+# (and its analytic jacobian) on a stamp of a given shape. These are built
+# once per stamp shape (see get_grid) so the objective function does no
+# allocation or I/O.
+# 
+# The model is the same as model_annulus, except the gaussian_filter-blurred
+# hole mask is replaced by its analytic equivalent (an erf edge of width
+# edge pixels) so it can be differentiated with respect to the hole
+# position and size. When the hole is held fixed (see fix_hole), the cached
+# hole_mask is used instead and the hole terms are not computed at all.
+# The star is separable, so it's built from the outer product of its x and y
+# profiles, and the offsets of each pixel from it are only computed for the
+# jacobian
+class annulus_grid:
+
+    def __init__(self, shape, edge=1.0):
+
+        self.shape = shape
+        self.edge = edge
+        ylen,xlen = shape
+        self.npix = xlen*ylen
+
+        # pixel coordinates (1-indexed, like model_annulus), flattened
+        self.xs = np.arange(1,xlen+1,dtype=np.float64)
+        self.ys = np.arange(1,ylen+1,dtype=np.float64)
+        self.x = np.tile(self.xs,ylen)
+        self.y = np.repeat(self.ys,xlen)
+
+        # a cached, fixed hole mask (see fix_hole)
+        self.fixed_mask = None
+
+        # scratch buffers
+        self.dx = np.empty(self.npix)
+        self.dy = np.empty(self.npix)
+        self.r2 = np.empty(self.npix)
+        self.psf = np.empty(self.npix)
+        self.dxh = np.empty(self.npix)
+        self.dyh = np.empty(self.npix)
+        self.dh = np.empty(self.npix)
+        self.mask = np.empty(self.npix)
+        self.phi = np.empty(self.npix)
+        self.tmp = np.empty(self.npix)
+        self.model = np.empty(self.npix)
+        self.resid = np.empty(self.npix)
+        self.jac = np.empty((self.npix,8))
+        self.mask_used = self.mask
+
+        # the data being fit (see set_image)
+        self.image = np.empty(self.npix)
+        self.inverr = np.empty(self.npix)
+
+        # the parameters the buffers were last evaluated at
+        self.pars = np.full(8,np.nan)
+
+    # copy the stamp (and its errors) into the grid's buffers
+    def set_image(self, image, err=None):
+        np.copyto(self.image, np.ravel(image))
+        if err is None:
+            # poisson errors, protected against empty/negative pixels
+            np.maximum(self.image, 1.0, out=self.inverr)
+            np.sqrt(self.inverr, out=self.inverr)
+        else: np.copyto(self.inverr, np.ravel(err))
+        np.reciprocal(self.inverr, out=self.inverr)
+        self.pars[:] = np.nan
+
+    # hold the hole at the given position and size, using the cached mask
+    def fix_hole(self, x_hole, y_hole, hole_size):
+        self.fixed_mask = hole_mask(self.shape, x_hole, y_hole, hole_size, edge=self.edge).ravel()
+        self.pars[:] = np.nan
+
+    def free_hole(self):
+        self.fixed_mask = None
+        self.pars[:] = np.nan
+
+    # evaluate the model and all intermediate terms at pars
+    def evaluate(self, pars):
+
+        if np.array_equal(pars, self.pars): return
+        x_center,y_center,sigma,background,amplitude,x_hole,y_hole,hole_size = pars
+
+        # gaussian star
+        gx = self.xs - x_center
+        np.multiply(gx, gx, out=gx)
+        np.multiply(gx, -0.5/(sigma*sigma), out=gx)
+        np.exp(gx, out=gx)
+        gy = self.ys - y_center
+        np.multiply(gy, gy, out=gy)
+        np.multiply(gy, -0.5/(sigma*sigma), out=gy)
+        np.exp(gy, out=gy)
+        np.multiply(gy[:,None], gx[None,:], out=self.psf.reshape(self.shape))
+
+        # the hole is fixed; the mask is a cache hit
+        if self.fixed_mask is not None:
+            self.mask_used = self.fixed_mask
+            np.multiply(self.fixed_mask, self.psf, out=self.model)
+            np.multiply(self.model, amplitude, out=self.model)
+            np.add(self.model, background, out=self.model)
+            np.copyto(self.pars, pars)
+            return
+
+        # fiber hole with a gaussian edge
+        self.mask_used = self.mask
+        np.subtract(self.x, x_hole, out=self.dxh)
+        np.subtract(self.y, y_hole, out=self.dyh)
+        np.hypot(self.dxh, self.dyh, out=self.dh)
+        np.maximum(self.dh, 1e-12, out=self.dh)
+        np.subtract(self.dh, hole_size, out=self.tmp)
+        np.multiply(self.tmp, 1.0/(np.sqrt(2.0)*self.edge), out=self.tmp)
+        erf(self.tmp, out=self.mask)
+        np.add(self.mask, 1.0, out=self.mask)
+        np.multiply(self.mask, 0.5, out=self.mask)
+        np.multiply(self.tmp, self.tmp, out=self.phi)
+        np.negative(self.phi, out=self.phi)
+        np.exp(self.phi, out=self.phi)
+        np.multiply(self.phi, 1.0/(np.sqrt(2.0*np.pi)*self.edge), out=self.phi)
+
+        # star * hole + background
+        np.multiply(self.mask, self.psf, out=self.model)
+        np.multiply(self.model, amplitude, out=self.model)
+        np.add(self.model, background, out=self.model)
+
+        np.copyto(self.pars, pars)
+
+    # the objective for least_squares: (image - model)/err
+    def residuals(self, pars):
+        self.evaluate(pars)
+        np.subtract(self.image, self.model, out=self.resid)
+        np.multiply(self.resid, self.inverr, out=self.resid)
+        return self.resid
+
+    # the analytic jacobian of residuals
+    def jacobian(self, pars):
+        self.evaluate(pars)
+        sigma = pars[2]
+        amplitude = pars[4]
+        jac = self.jac
+
+        # d/d(amplitude) = -mask*psf/err
+        np.multiply(self.mask_used, self.psf, out=self.tmp)
+        np.multiply(self.tmp, self.inverr, out=self.tmp)
+        np.negative(self.tmp, out=jac[:,4])
+
+        # star position and width (evaluate doesn't need the offsets from the star)
+        np.subtract(self.x, pars[0], out=self.dx)
+        np.subtract(self.y, pars[1], out=self.dy)
+        np.multiply(self.dx, self.dx, out=self.r2)
+        np.multiply(self.dy, self.dy, out=self.tmp)
+        np.add(self.r2, self.tmp, out=self.r2)
+        np.multiply(jac[:,4], amplitude/(sigma*sigma), out=self.tmp)
+        np.multiply(self.tmp, self.dx, out=jac[:,0])
+        np.multiply(self.tmp, self.dy, out=jac[:,1])
+        np.multiply(self.tmp, self.r2, out=jac[:,2])
+        np.multiply(jac[:,2], 1.0/sigma, out=jac[:,2])
+
+        # background
+        np.negative(self.inverr, out=jac[:,3])
+
+        # hole position and size (zero if the hole is fixed)
+        if self.fixed_mask is not None:
+            jac[:,5:] = 0.0
+            return jac
+        np.multiply(self.psf, self.phi, out=self.tmp)
+        np.multiply(self.tmp, self.inverr, out=self.tmp)
+        np.multiply(self.tmp, amplitude, out=jac[:,7])
+        np.divide(jac[:,7], self.dh, out=self.tmp)
+        np.multiply(self.tmp, self.dxh, out=jac[:,5])
+        np.multiply(self.tmp, self.dyh, out=jac[:,6])
+
+        return jac
+
+    # chi^2 of the model at pars
+    def chi2(self, pars):
+        resid = self.residuals(pars)
+        return np.dot(resid,resid)
+
+# grids are reused for every stamp with the same shape
+_grids = {}
+def get_grid(shape, edge=1.0):
+    key = (tuple(shape),edge)
+    if key not in _grids:
+        _grids[key] = annulus_grid(key[0], edge=edge)
+    return _grids[key]
+
+# a starting guess for a stamp around the fiber hole
+# (defaults to a star centered in the hole at the center of the stamp)
+def guess_pars(image, x_hole=None, y_hole=None, sigma=7.0, hole_size=9.8):
+    ylen,xlen = image.shape
+    if x_hole is None: x_hole = xlen/2.0
+    if y_hole is None: y_hole = ylen/2.0
+    background = np.median(image)
+    amplitude = np.amax(image)-background
+    return [x_hole,y_hole,sigma,background,amplitude,x_hole,y_hole,hole_size]
+
+# a noiseless model stamp (for simulations and calibrations)
+def render_annulus(shape, pars, edge=1.0):
+    grid = annulus_grid(shape, edge=edge)
+    grid.evaluate(np.asarray(pars,dtype=np.float64))
+    return grid.model.reshape(shape)
+
+# the production fit. Uses a cached annulus_grid and an analytic jacobian
+# (tens of ms per stamp vs ~2 s with model_annulus)
+# fixed - indices of parameters to hold at their value in pars
+#         (if the hole position and size are all fixed, the cached hole mask is used)
+def fit_annulus(image, pars=None, scale=None, err=None, fixed=None, **kwargs):
+
+    if pars is None:
         x_center = 0.1
         y_center = 0.3
         sigma = 7.0
@@ -93,13 +327,166 @@ def fit_annulus(image, pars=None, scale=None):
         hole_size = 7.0
         pars = [x_center,y_center,sigma,background,amplitude,x_hole,y_hole,hole_size]
 
-    err = np.sqrt(image)
+    if scale is None: scale = 1.0
+
+    grid = get_grid(image.shape)
+    grid.set_image(image, err=err)
 
 #    result = least_squares(model_annulus, pars, args=([image,err]), x_scale=scale)
-    result = least_squares(model_annulus, pars, args=(image,err), x_scale=scale, method='lm')
+#    result = least_squares(model_annulus, pars, args=(image,err), x_scale=scale, method='lm')
 #    result = minimize(model_annulus, pars, method='Nelder-Mead', args=(image,err))
+    pars = np.array(pars,dtype=np.float64)
+    if fixed is not None and set(annulus_tracker.HOLE) <= set(fixed):
+        grid.fix_hole(pars[5],pars[6],pars[7])
+    else: grid.free_hole()
+
+    if fixed is None or len(fixed) == 0:
+        result = least_squares(grid.residuals, pars, jac=grid.jacobian,
+                               x_scale=scale, method='lm', **kwargs)
+    else:
+        # only fit the free parameters
+        free = np.setdiff1d(np.arange(len(pars)), fixed)
+        if not np.isscalar(scale): scale = np.asarray(scale)[free]
+        full = pars.copy()
+
+        def residuals(p):
+            full[free] = p
+            return grid.residuals(full)
+        def jacobian(p):
+            full[free] = p
+            return grid.jacobian(full)[:,free]
+
+        result = least_squares(residuals, pars[free], jac=jacobian,
+                               x_scale=scale, method='lm', **kwargs)
+        full[free] = result.x
+        result.x = full
+        result.fixed = fixed
+
+    # the buffers are reused; make sure the result holds the residuals at the solution
+    result.x[2] = abs(result.x[2])
+    result.fun = grid.residuals(result.x).copy()
+    result.cost = 0.5*np.dot(result.fun,result.fun)
+    result.jac = grid.jacobian(result.x).copy()
     return result
     
+
+# fits the annulus model to consecutive guide frames, starting each fit
+# from the previous frame's solution. The hole position and size barely
+# change, so they are held fixed and only refit every refit_interval frames
+# (or after a failed fit). Positions are kept in detector coordinates so
+# the stamp may move between frames; x0,y0 is the offset of the stamp on
+# the detector (the same offset imager.get_stars adds to the stars)
+class annulus_tracker:
+
+    HOLE = [5,6,7]
+
+    def __init__(self, sigma=7.0, hole_size=9.8, refit_interval=20, scale=None):
+        self.sigma = sigma
+        self.hole_size = hole_size
+        self.refit_interval = refit_interval
+        self.scale = scale
+        self.reset()
+
+    # forget the previous solution; the next fit starts from scratch
+    def reset(self):
+        self.pars = None
+        self.nframes = 0
+        self.result = None
+
+    # x_hole,y_hole - the hole position in the stamp, for the first guess
+    def fit(self, image, x0=0.0, y0=0.0, x_hole=None, y_hole=None):
+
+        if self.pars is None:
+            pars = guess_pars(image, x_hole=x_hole, y_hole=y_hole, sigma=self.sigma, hole_size=self.hole_size)
+            fixed = None
+        else:
+            pars = np.array(self.pars)
+            pars[[0,5]] -= x0
+            pars[[1,6]] -= y0
+            # the brightness may change (clouds); re-seed it from the data
+            pars[3] = np.median(image)
+            pars[4] = max(np.amax(image)-pars[3], 1.0)
+            if (self.nframes % self.refit_interval) == 0: fixed = None
+            else: fixed = self.HOLE
+
+        result = fit_annulus(image, pars=pars, scale=self.scale, fixed=fixed)
+        self.result = result
+
+        # make sure the solution is sane before seeding the next frame with it
+        ylen,xlen = image.shape
+        if not result.success or not np.all(np.isfinite(result.x)) or \
+           result.x[0] < 1 or result.x[0] > xlen or result.x[1] < 1 or result.x[1] > ylen:
+            self.reset()
+            return result
+
+        self.pars = result.x.copy()
+        self.pars[[0,5]] += x0
+        self.pars[[1,6]] += y0
+        self.nframes += 1
+        return result
+
+# the best-fit parameters of each stamp, as returned by fit_annulus_batch
+PARNAMES = ['x_center','y_center','sigma','background','amplitude','x_hole','y_hole','hole_size']
+BATCH_DTYPE = np.dtype([(name,np.float64) for name in PARNAMES] +
+                       [('chi2',np.float64),('nfev',np.int32),('status',np.int32),('success',np.bool_)])
+
+# fit a single stamp for fit_annulus_batch (runs in a worker process)
+# item is a stamp or a FITS filename; region is (x1,x2,y1,y2), inclusive
+def _fit_batch_item(args):
+    item, region, pars, scale, fixed = args
+
+    row = np.zeros(1,dtype=BATCH_DTYPE)[0]
+    try:
+        if isinstance(item, str):
+            image = pyfits.getdata(item)
+            if region is not None:
+                x1,x2,y1,y2 = region
+                image = image[y1:y2+1,x1:x2+1]
+        else: image = item
+        image = np.asarray(image, dtype=np.float64)
+
+        if pars is None: p = guess_pars(image)
+        else: p = pars
+        result = fit_annulus(image, pars=p, scale=scale, fixed=fixed)
+    except Exception:
+        for name in PARNAMES: row[name] = np.nan
+        row['chi2'] = np.nan
+        row['status'] = -1
+        return row
+
+    for ii,name in enumerate(PARNAMES): row[name] = result.x[ii]
+    row['chi2'] = 2.0*result.cost
+    row['nfev'] = result.nfev
+    row['status'] = result.status
+    row['success'] = result.success
+    return row
+
+# fit many stamps (a stack of stamps, or a list of FITS files cut to region)
+# across a pool of nproc processes (default: all cores), in chunks of
+# chunksize stamps. Returns a structured array (BATCH_DTYPE), one row per
+# stamp, in the input order. A stamp that can't be read or fit has
+# status = -1. pars=None uses guess_pars on each stamp
+def fit_annulus_batch(stamps=None, filenames=None, region=None, pars=None, scale=None,
+                      fixed=None, nproc=None, chunksize=None):
+
+    if stamps is not None: items = list(stamps)
+    elif filenames is not None: items = list(filenames)
+    else: return np.zeros(0,dtype=BATCH_DTYPE)
+
+    if nproc is None: nproc = multiprocessing.cpu_count()
+    nproc = max(1, min(nproc, len(items)))
+    if chunksize is None: chunksize = max(1, int(np.ceil(len(items)/(4.0*nproc))))
+
+    tasks = [(item, region, pars, scale, fixed) for item in items]
+    if nproc == 1:
+        rows = [_fit_batch_item(task) for task in tasks]
+    else:
+        with multiprocessing.Pool(nproc) as pool:
+            rows = pool.map(_fit_batch_item, tasks, chunksize=chunksize)
+
+    results = np.zeros(len(rows),dtype=BATCH_DTYPE)
+    for ii,row in enumerate(rows): results[ii] = row
+    return results
     
 if __name__ == '__main__':
     
@@ -129,7 +516,13 @@ if __name__ == '__main__':
 
     junk = model_annulus(result.x, stamp, np.sqrt(stamp), save=True)
 
-    ipdb.set_trace()
+    # now fit the whole sequence
+    t0 = datetime.datetime.utcnow()
+    filenames = sorted(glob.glob('../data/test.*.guider.*.fits'))
+    results = fit_annulus_batch(filenames=filenames, region=(x1,x2,y1,y2), pars=result.x, scale=scale)
+    print('fit ' + str(len(results)) + ' stamps in ' + str((datetime.datetime.utcnow()-t0).total_seconds()) + ' s')
+    for filename,row in zip(filenames,results):
+        print(filename, row['x_center'], row['y_center'], row['sigma'], row['hole_size'], row['chi2'], row['success'])
 
     boxsize = 99
     mu = 0.0
@@ -11,7 +11,9 @@ import pdu
 
 class calstage:
 
-    def __init__(self, base_directory, config_file, logger=None, simulate=False):
+    # on_move - called (with no arguments) after each move_and_wait, e.g. to
+    #           refresh a cached copy of the position
+    def __init__(self, base_directory, config_file, logger=None, simulate=False, on_move=None):
         self.base_directory=base_directory
         self.config_file = self.base_directory + '/config/' + config_file
 
@@ -41,6 +43,7 @@ class calstage:
         self.maxpos = None
         self.simulate = simulate
         self.simulated_position = 0.0
+        self.on_move = on_move
         self.port = config['PORT']
         self.pdu = pdu.pdu(self.base_directory, 'pdu.ini')
 
@@ -141,6 +144,10 @@ class calstage:
         if not self.simulate:
             pitools.waitontarget(self.calstage, axes=['1'])
 
+        if self.on_move != None:
+            try: self.on_move()
+            except: self.logger.exception("Error after moving the stage")
+
         # make sure it moved where we wanted (within tolerance)
         if abs(position - self.get_position()) > tol:
             self.logger.error("Error moving to requested position")
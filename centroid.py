@@ -4,10 +4,12 @@ from photutils import DAOStarFinder
 from astropy.stats import sigma_clipped_stats
 from astropy.io import fits as pyfits
 import sep
-import datetime, os
+import datetime, os, time
 import utils
 import ipdb
 import annulus
+from collections import OrderedDict
+from scipy.interpolate import griddata
 
 # this contains several different (swappable) algorithms to identify stars and return their x, y, intensity, and fwhm
 # they have different advantages for speed and accuracy
@@ -15,105 +17,588 @@ import annulus
 # determine the centroid in the presence of a hole using
 # a full model of star + hole
 # the input image should be a postage stamp around the fiber hole with one star
-# slow (2s), but most precise. Use in high SNR when cadence is not important
+# slowest (tens of ms), but most precise. Use in high SNR
 # also logs additional information useful for monitoring system evolution (hole position, FWHM, brightness)
-def get_stars_model_annulus(image, filename=None):
+# tracker - an annulus.annulus_tracker to warm start the fit from the previous frame
+#           (x0,y0 is the offset of this stamp on the detector)
+# x_hole, y_hole - the hole position in the stamp for the first guess (default: the center)
+# the flux is the integrated flux of the star (including what falls in the
+# hole), 2*pi*sigma^2*amplitude, so it's on the same scale as get_stars_sep
+def get_stars_model_annulus(image, filename=None, tracker=None, x0=0.0, y0=0.0, x_hole=None, y_hole=None):
     if filename != None:
         image = pyfits.getdata(filename)
 
-    ylen,xlen=image.shape
-    x_center = xlen/2.0
-    x_hole = xlen/2.0
-    y_center = xlen/2.0
-    y_hole = xlen/2.0
-    sigma = 7.0
-    background = np.median(image)
-    amplitude = np.amax(image)-background
-    hole_size = 9.8
-    pars = [x_center,y_center,sigma,background,amplitude,x_hole,y_hole,hole_size]
-    best = annulus.fit_annulus(image,pars)
-    return np.transpose(np.vstack((best[0], best[1], best[4])))
+    if tracker != None:
+        best = tracker.fit(image, x0=x0, y0=y0, x_hole=x_hole, y_hole=y_hole).x
+    else:
+        pars = annulus.guess_pars(image, x_hole=x_hole, y_hole=y_hole, sigma=7.0, hole_size=9.8)
+        best = annulus.fit_annulus(image,pars).x
+    flux = 2.0*np.pi*best[2]**2*best[4]
+    return np.transpose(np.vstack((best[0], best[1], flux)))
+
+
+# the fast annulus centroiders below are biased by the fiber hole, which
+# removes the core of the star. They are corrected with a table of the
+# estimator's response to a noiseless annulus model (annulus.render_annulus)
+# of a star at known offsets from the hole, so they agree with the full
+# model fit. Positions are 1-indexed, like get_stars_model_annulus
+# building a table takes 10-100 ms, so they are cached (the most recent
+# ANNULUS_TABLE_CACHE_SIZE), keyed on the stamp shape, the star width and
+# estimator options binned to quantum pixels, and the hole size and the
+# position of the hole within its pixel binned to 0.1 pixel. Otherwise
+# the response depends on the offset from the hole, not where the hole is in
+# the stamp, so the tables are made with the hole near the center of the stamp
+ANNULUS_TABLE_CACHE_SIZE = 16
+_annulus_bias_tables = OrderedDict()
+def _cached_table(key, build):
+    if key in _annulus_bias_tables:
+        _annulus_bias_tables.move_to_end(key)
+        return _annulus_bias_tables[key]
+    table = build()
+    _annulus_bias_tables[key] = table
+    if len(_annulus_bias_tables) > ANNULUS_TABLE_CACHE_SIZE:
+        _annulus_bias_tables.popitem(last=False)
+    return table
+
+def _bin(value, quantum):
+    return round(value/quantum)*quantum
+
+def annulus_bias_table(estimator, shape, x_hole, y_hole, sigma=7.0, hole_size=9.8, npts=41, quantum=0.25, **kwargs):
+
+    sigma = _bin(sigma, quantum)
+    hole_size = _bin(hole_size, 0.1)
+    kwargs = {name:_bin(value, quantum) for name,value in kwargs.items()}
+    ylen,xlen = shape
+    x_hole = xlen//2 + _bin(x_hole % 1.0, 0.1)
+    y_hole = ylen//2 + _bin(y_hole % 1.0, 0.1)
+    key = (estimator.__name__, tuple(shape), x_hole, y_hole, sigma, hole_size, npts, tuple(sorted(kwargs.items())))
+
+    def build():
+        # offsets along +X, out to where the star leaves the stamp
+        max_offset = max(min(hole_size+2.0*sigma, xlen-x_hole-1.0), 1.0)
+        offsets = np.linspace(0.0, max_offset, npts)
+        response = np.zeros(npts)
+        for ii in range(npts):
+            pars = [x_hole+offsets[ii],y_hole,sigma,0.0,1.0,x_hole,y_hole,hole_size]
+            model = annulus.render_annulus(shape, pars)
+            response[ii] = estimator(model, x_hole, y_hole, **kwargs)[0]
+
+        # the response must be monotonic to be inverted
+        response = np.maximum.accumulate(response)
+        return offsets,response
+
+    return _cached_table(key, build)
+
+# undo the (radially symmetric) hole bias of a measured offset from the hole
+def _correct_radial_bias(dx, dy, table):
+    offsets,response = table
+    r = np.hypot(dx,dy)
+    if r == 0.0: return dx,dy
+    scale = np.interp(r, response, offsets, right=offsets[-1]+r-response[-1])/r
+    return dx*scale, dy*scale
+
+# the quad cell signal saturates along each axis, so unlike the other
+# estimators its bias is not radial: (qx,qy) depends on both offsets. The
+# calibration is the 2-D inverse, the offset (dx,dy) from the hole tabulated
+# on a regular grid of (|qx|,|qy|), made from the signal at a grid of npts x
+# npts offsets from the hole (cached like annulus_bias_table). The quadrants
+# are assumed to be mirror images
+def quad_calibration_table(shape, x_hole, y_hole, sigma=7.0, hole_size=9.8, radius=21.0, npts=21, nq=41, quantum=0.25):
+
+    sigma = _bin(sigma, quantum)
+    hole_size = _bin(hole_size, 0.1)
+    radius = _bin(radius, quantum)
+    ylen,xlen = shape
+    x_hole = xlen//2 + _bin(x_hole % 1.0, 0.1)
+    y_hole = ylen//2 + _bin(y_hole % 1.0, 0.1)
+    key = ('quad_calibration_table', tuple(shape), x_hole, y_hole, sigma, hole_size, radius, npts, nq)
+
+    def build():
+        # offsets in the first quadrant, out to where the star leaves the stamp
+        max_offset = max(min(hole_size+2.0*sigma, xlen-x_hole-1.0, ylen-y_hole-1.0), 1.0)
+        offsets = np.linspace(0.0, max_offset, npts)
+        dx,dy = np.meshgrid(offsets, offsets)
+        dx = dx.ravel()
+        dy = dy.ravel()
+        q = np.zeros((len(dx),2))
+        for ii in range(len(dx)):
+            pars = [x_hole+dx[ii],y_hole+dy[ii],sigma,0.0,1.0,x_hole,y_hole,hole_size]
+            model = annulus.render_annulus(shape, pars)
+            q[ii] = _quad_annulus(model, x_hole, y_hole, radius=radius)[0:2]
+        return _invert_quad_samples(np.abs(q), dx, dy, nq)
+
+    return _cached_table(key, build)
+
+# tabulate the offsets (dx,dy) from the hole, sampled at quad signals q
+# (first quadrant), on a regular nq x nq grid of q
+def _invert_quad_samples(q, dx, dy, nq):
+    qgrid = np.linspace(0.0, max(np.amax(q),1e-6), nq)
+    qx,qy = np.meshgrid(qgrid, qgrid)
+    grid = np.zeros((2,nq,nq))
+    for ii,offset in enumerate((dx,dy)):
+        grid[ii] = griddata(q, offset, (qx,qy), method='linear')
+        # beyond the samples (e.g., where the signal saturates), use the nearest
+        outside = ~np.isfinite(grid[ii])
+        if outside.any():
+            grid[ii][outside] = griddata(q, offset, (qx[outside],qy[outside]), method='nearest')
+    return qgrid, grid[0], grid[1]
+
+# the offset (dx,dy) from the hole for the quad cell signal (qx,qy)
+# (bilinear interpolation in the quad_calibration_table)
+def _invert_quad(qx, qy, table):
+    qgrid,dxgrid,dygrid = table
+    step = qgrid[1]-qgrid[0]
+    nq = len(qgrid)
+    u = min(abs(qx)/step, nq-1.0)
+    v = min(abs(qy)/step, nq-1.0)
+    i = min(int(u), nq-2)
+    j = min(int(v), nq-2)
+    fu = u-i
+    fv = v-j
+    w = np.array([[(1.0-fv)*(1.0-fu), (1.0-fv)*fu],
+                  [fv*(1.0-fu), fv*fu]])
+    dx = np.sum(w*dxgrid[j:j+2,i:i+2])
+    dy = np.sum(w*dygrid[j:j+2,i:i+2])
+    return np.sign(qx)*dx, np.sign(qy)*dy
+
+# the window and pixel coordinates for the fast annulus centroiders.
+# The hole barely moves while guiding, so the most recent
+# ANNULUS_WINDOW_CACHE_SIZE are cached per stamp shape, hole position and
+# window radius; callers with arbitrary centers (get_stars_com) pass
+# cache=False so they don't flush it
+ANNULUS_WINDOW_CACHE_SIZE = 32
+_annulus_windows = OrderedDict()
+def _annulus_window(shape, x_hole, y_hole, radius, cache=True):
+    if not cache: return _make_annulus_window(shape, x_hole, y_hole, radius)
+
+    key = (tuple(shape), round(x_hole,2), round(y_hole,2), round(radius,2))
+    if key in _annulus_windows:
+        _annulus_windows.move_to_end(key)
+        return _annulus_windows[key]
+    window = _make_annulus_window(shape, x_hole, y_hole, radius)
+    _annulus_windows[key] = window
+    if len(_annulus_windows) > ANNULUS_WINDOW_CACHE_SIZE:
+        _annulus_windows.popitem(last=False)
+    return window
+
+def _make_annulus_window(shape, x_hole, y_hole, radius):
+    ylen,xlen = shape
+    x = np.arange(1,xlen+1,dtype=np.float64)
+    y = np.arange(1,ylen+1,dtype=np.float64)
+    window = (np.hypot(x[None,:]-x_hole, y[:,None]-y_hole) <= radius).astype(np.float64)
+    # +1 right of (above) the hole, -1 left of (below) it, split for the pixel containing it
+    xsign = np.clip(2.0*(x-x_hole), -1.0, 1.0)
+    ysign = np.clip(2.0*(y-y_hole), -1.0, 1.0)
+    return x,y,window,xsign,ysign
+
+# the background of a stamp, from the median of its border
+def _stamp_background(image):
+    return np.median(np.concatenate((image[0,:],image[-1,:],image[1:-1,0],image[1:-1,-1])))
+
+# the raw (biased) center of mass within radius of the hole, relative to the hole
+def _com_annulus(image, x_hole, y_hole, radius=21.0, cache=True):
+    x,y,window,xsign,ysign = _annulus_window(image.shape, x_hole, y_hole, radius, cache=cache)
+    d = (image - _stamp_background(image))*window
+    colsum = d.sum(axis=0)
+    rowsum = d.sum(axis=1)
+    flux = colsum.sum()
+    if flux <= 0.0: return np.nan, np.nan, flux
+    return np.dot(colsum,x)/flux - x_hole, np.dot(rowsum,y)/flux - y_hole, flux
+
+# the raw quad cell signal within radius of the hole:
+# (right-left)/(right+left) and (top-bottom)/(top+bottom)
+def _quad_annulus(image, x_hole, y_hole, radius=21.0):
+    x,y,window,xsign,ysign = _annulus_window(image.shape, x_hole, y_hole, radius)
+    d = (image - _stamp_background(image))*window
+    colsum = d.sum(axis=0)
+    rowsum = d.sum(axis=1)
+    flux = colsum.sum()
+    if flux <= 0.0: return np.nan, np.nan, flux
+    return np.dot(colsum,xsign)/flux, np.dot(rowsum,ysign)/flux, flux
+
+# make the quad cell calibration (like quad_calibration_table) from real
+# stamps, using their full model fits (e.g., from annulus.fit_annulus_batch)
+# as the truth. The stamps are folded into the first quadrant, and mirrored
+# about the diagonal, to fill the table
+def calibrate_quad_annulus(stamps, fits, x_hole, y_hole, radius=21.0, nq=41):
+
+    good = fits['success']
+    q = np.array([_quad_annulus(stamp, x_hole, y_hole, radius=radius)[0:2] for stamp in stamps[good]])
+    dx = fits['x_center'][good]-x_hole
+    dy = fits['y_center'][good]-y_hole
+    ok = np.isfinite(q).all(axis=1)
+    q = np.abs(q[ok])
+    dx = np.abs(dx[ok])
+    dy = np.abs(dy[ok])
+
+    q = np.concatenate((q, q[:,::-1]))
+    dx,dy = np.concatenate((dx,dy)), np.concatenate((dy,dx))
+    return _invert_quad_samples(q, dx, dy, nq)
+
+# the center of mass of a star within radius of (x,y) (1-indexed), for a
+# stamp without the fiber hole in it (default: the center of the stamp)
+def get_stars_com(image, filename=None, x=None, y=None, radius=None):
+    if filename != None:
+        image = pyfits.getdata(filename)
+
+    ylen,xlen = image.shape
+    if x == None: x = xlen/2.0
+    if y == None: y = ylen/2.0
+    if radius == None: radius = min(xlen,ylen)/2.0
 
+    dx,dy,flux = _com_annulus(image, x, y, radius=radius, cache=False)
+    if not flux > 0.0: return []
+    return np.array([[x+dx, y+dy, flux]])
 
 # determine the centroid in the presence of a hole using
 # center of mass plus an empirical correction 
 # the input image should be a postage stamp around the fiber hole with one star
-# least accurate, fast. Use for low SNR
-def get_stars_com_annulus(image, filename=None):
+# least accurate, fastest (~0.1 ms). Use for low SNR
+# the window is centered on the hole, so it is only accurate while the star
+# is within about hole_size of the hole (i.e., while guiding)
+# x_hole, y_hole - the hole position in the stamp (default: the center)
+# sigma, hole_size - the star width and hole size the correction is calibrated for
+# radius - the center of mass window around the hole (default 3*sigma)
+# table - the bias table (default: from annulus_bias_table)
+def get_stars_com_annulus(image, filename=None, x_hole=None, y_hole=None, sigma=7.0, hole_size=9.8, radius=None, table=None):
     if filename != None:
         image = pyfits.getdata(filename)
-        
+
+    ylen,xlen = image.shape
+    if x_hole == None: x_hole = xlen/2.0
+    if y_hole == None: y_hole = ylen/2.0
+    if radius == None: radius = 3.0*sigma
+
+    dx,dy,flux = _com_annulus(image, x_hole, y_hole, radius=radius)
+    if not flux > 0.0: return []
+
+    if table == None:
+        table = annulus_bias_table(_com_annulus, image.shape, x_hole, y_hole, sigma=sigma, hole_size=hole_size, radius=radius)
+    dx,dy = _correct_radial_bias(dx, dy, table)
+    return np.array([[x_hole+dx, y_hole+dy, flux]])
+
 # determine the centroid in the presence of a hole using
 # the power in 4 quadrants plus an empirical correction
 # the input image should be a postage stamp around the fiber hole with one star
-# 
-def get_stars_quad_annulus(image, filename=None):
+# fast (~0.1 ms), constant time. The calibration comes from
+# quad_calibration_table, or from calibrate_quad_annulus (calibration=)
+# like get_stars_com_annulus, only accurate while the star is near the hole
+def get_stars_quad_annulus(image, filename=None, x_hole=None, y_hole=None, sigma=7.0, hole_size=9.8, radius=None, calibration=None):
     if filename != None:
         image = pyfits.getdata(filename)
 
+    ylen,xlen = image.shape
+    if x_hole == None: x_hole = xlen/2.0
+    if y_hole == None: y_hole = ylen/2.0
+    if radius == None: radius = 3.0*sigma
+
+    qx,qy,flux = _quad_annulus(image, x_hole, y_hole, radius=radius)
+    if not flux > 0.0: return []
+
+    if calibration == None:
+        calibration = quad_calibration_table(image.shape, x_hole, y_hole, sigma=sigma, hole_size=hole_size, radius=radius)
+    dx,dy = _invert_quad(qx, qy, calibration)
+    return np.array([[x_hole+dx, y_hole+dy, flux]])
+
+# the raw (biased) SEP windowed position of the star, relative to the hole
+# sig - the gaussian sigma of the winpos window. It must be wider than the
+#       donut (~2x the star's sigma), or winpos locks onto one side of the ring
+def _sep_annulus(image, x_hole, y_hole, sig=14.0):
+    data = np.array(image, dtype=np.float64)
+    data -= _stamp_background(data)
+
+    # start from the brightest detection (the donut shouldn't be deblended
+    # into pieces), or from the hole if the star is too faint to detect
+    # sep is 0-indexed
+    noise = max(np.std(data[0,:]), 1e-6*np.amax(data))
+    try:
+        stars = sep.extract(data, 3.0, err=noise, minarea=5, deblend_cont=1.0)
+    except Exception:
+        stars = []
+    if len(stars) > 0:
+        best = np.argmax(stars['flux'])
+        x0,y0 = stars['x'][best], stars['y'][best]
+    else: x0,y0 = x_hole-1.0, y_hole-1.0
+
+    x,y,flag = sep.winpos(data, [x0], [y0], sig)
+    flux,fluxerr,flag = sep.sum_circle(data, x, y, 1.5*sig)
+    return x[0]+1.0-x_hole, y[0]+1.0-y_hole, flux[0]
+
 # determine the centroid in the presence of a hole using
 # SEP position plus an empirical correction 
 # the input image should be a postage stamp around the fiber hole with one star
-def get_stars_sep_annulus(image, filename=None):
+# faster than get_stars_model_annulus, more accurate than
+# get_stars_com_annulus/get_stars_quad_annulus. Use for moderate SNR
+# table - the bias table (default: from annulus_bias_table)
+def get_stars_sep_annulus(image, filename=None, x_hole=None, y_hole=None, sigma=7.0, hole_size=9.8, table=None):
     if filename != None:
         image = pyfits.getdata(filename)
 
+    ylen,xlen = image.shape
+    if x_hole == None: x_hole = xlen/2.0
+    if y_hole == None: y_hole = ylen/2.0
+
+    dx,dy,flux = _sep_annulus(image, x_hole, y_hole, sig=2.0*sigma)
+    if not flux > 0.0 or not np.isfinite(dx): return []
+
+    if table == None:
+        table = annulus_bias_table(_sep_annulus, image.shape, x_hole, y_hole, sigma=sigma, hole_size=hole_size, sig=2.0*sigma)
+    dx,dy = _correct_radial_bias(dx, dy, table)
+    return np.array([[x_hole+dx, y_hole+dy, flux]])
+
+# picks which annulus centroider to run on each stamp: the most accurate one
+# at the stamp's SNR that is expected to finish before the deadline (a
+# time.monotonic() time, e.g., when the next exposure ends). If none will,
+# the fastest runs. The run time of each is tracked (exponentially weighted),
+# and the choice and time is logged for every stamp
+# how accurate each one is at each SNR comes from calibrate (a Monte Carlo
+# of noisy model stamps); until then, they're assumed to be in the order of
+# self.algorithms (the full model fit first) at every SNR
+# the SNR is the matched filter SNR of a star centered on the hole, which is
+# insensitive to the background level
+# if the tracker has a solution, its hole position is used by the fast
+# centroiders. Their bias tables are built once, for the nominal star width
+# and hole size (sigma, hole_size), when the scheduler is made (for stamps of
+# shape, with the hole at x_hole, y_hole) or when a new stamp shape is seen,
+# and never count against the run time
+class centroid_scheduler:
+
+    def __init__(self, logger=None, tracker=None, sigma=7.0, hole_size=9.8, shape=None, x_hole=None, y_hole=None):
+        self.logger = logger
+        self.tracker = tracker
+        self.sigma = sigma
+        self.hole_size = hole_size
+
+        # most accurate first: name, initial run time guess (s)
+        self.algorithms = [('model', 0.02),
+                           ('sep',   0.002),
+                           ('quad',  0.0002),
+                           ('com',   0.0002)]
+        self.runtime = {}
+        for name,runtime in self.algorithms: self.runtime[name] = runtime
+        self.weight = 0.2
+
+        # from calibrate: the SNRs, and the 90th percentile position error
+        # (pixels) of each centroider at each of them
+        self.accuracy = None
+
+        # bias tables for each fast centroider, and the SNR filter, for one stamp shape
+        self.tables = {}
+        self.table_shape = None
+        if shape != None: self.prepare(shape, x_hole=x_hole, y_hole=y_hole)
+
+        # what ran last: (name, run time, SNR)
+        self.last = None
+
+    # build the bias tables for stamps of shape, with the hole at x_hole, y_hole (default: the center)
+    def prepare(self, shape, x_hole=None, y_hole=None):
+        ylen,xlen = shape
+        if x_hole == None: x_hole = xlen/2.0
+        if y_hole == None: y_hole = ylen/2.0
+        radius = 3.0*self.sigma
+        self.tables = {'sep':annulus_bias_table(_sep_annulus, shape, x_hole, y_hole, sigma=self.sigma,
+                                                hole_size=self.hole_size, sig=2.0*self.sigma),
+                       'quad':quad_calibration_table(shape, x_hole, y_hole, sigma=self.sigma,
+                                                     hole_size=self.hole_size, radius=radius),
+                       'com':annulus_bias_table(_com_annulus, shape, x_hole, y_hole, sigma=self.sigma,
+                                                hole_size=self.hole_size, radius=radius)}
+        self.table_shape = tuple(shape)
+        self.x_table = x_hole
+        self.y_table = y_hole
+
+        # the matched filter for the SNR: the profile of a star on the hole,
+        # minus its mean within 3 sigma (so the background cancels)
+        profile = annulus.render_annulus(shape, [x_hole,y_hole,self.sigma,0.0,1.0,x_hole,y_hole,self.hole_size])
+        x,y,window,xsign,ysign = _make_annulus_window(shape, x_hole, y_hole, radius)
+        self.snr_filter = (profile - np.sum(profile*window)/np.sum(window))*window
+        self.snr_norm = np.sqrt(np.sum(self.snr_filter**2))
+
+    # the matched filter SNR of the star in the stamp
+    def snr(self, image):
+        border = np.concatenate((image[0,:],image[-1,:],image[1:-1,0],image[1:-1,-1]))
+        noise = 1.4826*np.median(np.abs(border - np.median(border)))
+        if noise <= 0.0: noise = max(np.std(border), 1e-6)
+        return max(np.sum(self.snr_filter*image)/(noise*self.snr_norm), 0.0)
+
+    # measure the accuracy of each centroider vs. SNR, from ntrials noisy
+    # model stamps at each star amplitude (in units of the noise), with the
+    # star within hole_size/2 of the hole (as while guiding). Takes ~1 s
+    def calibrate(self, shape=None, amplitudes=(1.0,2.0,4.0,8.0,16.0,64.0), ntrials=8, seed=0):
+        if shape != None and tuple(shape) != self.table_shape: self.prepare(shape)
+        shape = self.table_shape
+        x_hole,y_hole = self.x_table,self.y_table
+        rng = np.random.default_rng(seed)
+        failed = float(np.hypot(shape[0],shape[1]))
+
+        snrs = []
+        errors = {name:[] for name,runtime in self.algorithms}
+        for amplitude in amplitudes:
+            level_snrs = []
+            level_errors = {name:[] for name,runtime in self.algorithms}
+            for ii in range(ntrials):
+                r = 0.5*self.hole_size*np.sqrt(rng.uniform())
+                theta = rng.uniform(0.0, 2.0*np.pi)
+                x = x_hole + r*np.cos(theta)
+                y = y_hole + r*np.sin(theta)
+                image = annulus.render_annulus(shape, [x,y,self.sigma,0.0,amplitude,x_hole,y_hole,self.hole_size])
+                image = image + rng.normal(0.0, 1.0, shape)
+                level_snrs.append(self.snr(image))
+                for name,runtime in self.algorithms:
+                    # the model fit is warm started from the truth, like the tracker
+                    stars = self.run(name, image, x_hole, y_hole, guess=[x,y,self.sigma,0.0,amplitude,
+                                                                         x_hole,y_hole,self.hole_size])
+                    if len(stars) == 0 or not np.all(np.isfinite(stars[0,0:2])): level_errors[name].append(failed)
+                    else: level_errors[name].append(min(np.hypot(stars[0,0]-x, stars[0,1]-y), failed))
+            snrs.append(np.median(level_snrs))
+            for name in errors: errors[name].append(np.percentile(level_errors[name], 90))
+
+        order = np.argsort(snrs)
+        self.accuracy = (np.array(snrs)[order], {name:np.array(errors[name])[order] for name in errors})
+        if self.logger != None:
+            self.logger.info("Centroider 90th percentile errors (pixels) at SNR " +
+                             str(np.round(self.accuracy[0],1)) + ': ' +
+                             str({name:np.round(err,2).tolist() for name,err in self.accuracy[1].items()}))
+
+    # the expected (90th percentile) error of each centroider at snr, or
+    # their rank if not calibrated
+    def expected_error(self, snr):
+        if self.accuracy == None:
+            return {name:float(ii) for ii,(name,runtime) in enumerate(self.algorithms)}
+        snrs,errors = self.accuracy
+        return {name:float(np.interp(snr, snrs, errors[name])) for name in errors}
+
+    def choose(self, snr, deadline=None):
+        if deadline == None: remaining = float('inf')
+        else: remaining = deadline - time.monotonic()
+        error = self.expected_error(snr)
+        fits = [name for name,runtime in self.algorithms if self.runtime[name] <= remaining]
+        if len(fits) > 0: return min(fits, key=lambda name: error[name])
+        # we're behind; run the fastest
+        return min(self.runtime, key=self.runtime.get)
+
+    # run centroider name on the stamp
+    # guess - the model fit's initial parameters (default: the tracker, or a guess)
+    def run(self, name, image, x_hole, y_hole, x0=0.0, y0=0.0, guess=None):
+        if name == 'model':
+            if guess != None:
+                best = annulus.fit_annulus(image, guess).x
+                return np.array([[best[0], best[1], 2.0*np.pi*best[2]**2*best[4]]])
+            return get_stars_model_annulus(image, tracker=self.tracker, x0=x0, y0=y0, x_hole=x_hole, y_hole=y_hole)
+        if name == 'sep':
+            return get_stars_sep_annulus(image, x_hole=x_hole, y_hole=y_hole, sigma=self.sigma,
+                                         hole_size=self.hole_size, table=self.tables['sep'])
+        if name == 'quad':
+            return get_stars_quad_annulus(image, x_hole=x_hole, y_hole=y_hole, sigma=self.sigma,
+                                          hole_size=self.hole_size, calibration=self.tables['quad'])
+        return get_stars_com_annulus(image, x_hole=x_hole, y_hole=y_hole, sigma=self.sigma,
+                                     hole_size=self.hole_size, table=self.tables['com'])
+
+    # x_hole, y_hole - the hole in the stamp (default: the center)
+    # x0, y0 - the offset of this stamp on the detector (for the tracker)
+    def get_stars(self, image, deadline=None, x_hole=None, y_hole=None, x0=0.0, y0=0.0):
+
+        ylen,xlen = image.shape
+        if x_hole == None: x_hole = xlen/2.0
+        if y_hole == None: y_hole = ylen/2.0
+        if self.tracker != None and self.tracker.pars is not None:
+            x_hole = self.tracker.pars[5]-x0
+            y_hole = self.tracker.pars[6]-y0
+
+        # a new stamp shape (slow, but only once)
+        if self.table_shape != tuple(image.shape): self.prepare(image.shape, x_hole=x_hole, y_hole=y_hole)
+
+        snr = self.snr(image)
+        name = self.choose(snr, deadline=deadline)
+
+        t0 = time.monotonic()
+        stars = self.run(name, image, x_hole, y_hole, x0=x0, y0=y0)
+        elapsed = time.monotonic()-t0
+
+        self.runtime[name] = (1.0-self.weight)*self.runtime[name] + self.weight*elapsed
+        self.last = (name, elapsed, snr)
+        if self.logger != None:
+            self.logger.info("Centroided with " + name + " (SNR=" + str(round(snr,1)) + ") in " + str(round(elapsed*1000.0,2)) + " ms")
+        return stars
+
 # fast but not very accurate
+# works on the camera's native (uint16) data, in reused scratch buffers
 def get_stars_cv(image, filename=None):
     if filename != None:
         image = pyfits.getdata(filename)
 
-    d = np.array(image, dtype='float')
-    th = threshold_pyguide(d, level = 4)
+    th = threshold_pyguide(image, level = 4)
 
     # all zero image
-    if np.max(image*th) == 0.0:
+    peak = np.max(image, where=th, initial=0)
+    if peak <= 0:
         return []
 
-    imtofeed = np.array(np.round((d*th)/np.max(d*th)*255), dtype='uint8')
+    # scale the thresholded image to 8 bits
+    scaled = _scratch('cv_scaled', image.shape, np.float32)
+    np.multiply(image, np.float32(255.0/peak), out=scaled, casting='unsafe')
+    np.multiply(scaled, th, out=scaled)
+    np.rint(scaled, out=scaled)
+    imtofeed = _scratch('cv_uint8', image.shape, np.uint8)
+    np.copyto(imtofeed, scaled, casting='unsafe')
     return centroid_all_blobs(imtofeed)
 
+# scratch buffers reused from frame to frame, by name, shape and dtype
+# (the contents are overwritten by the next caller with the same name)
+_scratch_buffers = {}
+def _scratch(name, shape, dtype):
+    buf = _scratch_buffers.get(name)
+    if buf is None or buf.shape != tuple(shape) or buf.dtype != dtype:
+        buf = np.empty(shape, dtype=dtype)
+        _scratch_buffers[name] = buf
+    return buf
+
 # helper function for get_stars_cv
-def centroid_all_blobs(thresholded_image, areacutoff=30):
-    thresholded_copy = thresholded_image.copy()
-    contours,hierarchy = cv2.findContours(thresholded_copy,
-                                        cv2.RETR_LIST,
-                                        cv2.CHAIN_APPROX_SIMPLE)
-    if len(contours)==0:
+# finds every blob (8-connected group of nonzero pixels) larger than areacutoff pixels
+# returns (x, y, area) of each, or (x, y, total intensity) if weighted,
+# from connected components, so it's linear in the number of pixels and blobs
+def centroid_all_blobs(thresholded_image, areacutoff=30, weighted=False):
+    # any nonzero 8 bit pixel is foreground; label 0 is the background
+    if thresholded_image.dtype == np.uint8: binary = thresholded_image
+    else: binary = (thresholded_image > 0).astype(np.uint8)
+    nlabels,labels,stats,centroids = cv2.connectedComponentsWithStats(binary, connectivity=8)
+    if nlabels < 2:
         return np.zeros((1, 3))
 
+    area = stats[1:,cv2.CC_STAT_AREA]
+    keep = np.flatnonzero(area >= areacutoff)
+
+    if weighted:
+        # intensity weighted moments of every blob in one pass
+        ylen,xlen = thresholded_image.shape
+        w = thresholded_image.astype(np.float64)
+        lab = labels.ravel()
+        m00 = np.bincount(lab, weights=w.ravel(), minlength=nlabels)[1:]
+        m10 = np.bincount(lab, weights=(w*np.arange(xlen)[None,:]).ravel(), minlength=nlabels)[1:]
+        m01 = np.bincount(lab, weights=(w*np.arange(ylen)[:,None]).ravel(), minlength=nlabels)[1:]
+        cx = m10/np.maximum(m00,1e-30)
+        cy = m01/np.maximum(m00,1e-30)
+        ssum = m00
     else:
-        outarray = np.zeros((1, 3))
-        counter = 0
-        for cnt in contours:
-            M = cv2.moments(cnt)
-            if M['m00']<areacutoff:
-                counter = counter+1
-                continue
-            cx,cy,ssum = (M['m10']/M['m00']), (M['m01']/M['m00']), M['m00']
-            outarray=np.vstack((outarray, np.array((cx, cy, ssum))))
-    return outarray[1:,:]
+        cx = centroids[1:,0]
+        cy = centroids[1:,1]
+        ssum = area
+
+    outarray = np.empty((len(keep),3))
+    outarray[:,0] = cx[keep]
+    outarray[:,1] = cy[keep]
+    outarray[:,2] = ssum[keep]
+    return outarray
 
 # helper function for get_stars_cv
-def threshold_pyguide(image,level =3):
-    stddev = robust_std(image)
-    median = np.median(image)
+# step - see utils.robust_stats
+def threshold_pyguide(image,level =3, step=1):
+    median,q1,q3,stddev = utils.robust_stats(image, step=step)
     goodpix = image>median+stddev*level
     return goodpix
 
 # helper function for get_stars_cv
-def robust_std(x):
-    y = x.flatten()
-    n = len(y)
-    y.sort()
-    ind_qt1 = int(round((n+1)/4.))
-    ind_qt3 = int(round((n+1)*3/4.))
-    IQR = y[ind_qt3]- y[ind_qt1]
-    lowFense = y[ind_qt1] - 1.5*IQR
-    highFense = y[ind_qt3] + 1.5*IQR
-    ok = (y>lowFense)*(y<highFense)
-    yy=y[ok]
-    return yy.std(dtype='double')
+def robust_std(x, step=1):
+    return utils.robust_stats(x, step=step)[3]
 
 # finds the integer pixel value for the brightest star in the image
 # only useful if we know we want to target the brightest star in the image
@@ -170,19 +655,60 @@ def get_stars_sex(image, filename=None):
 
     return np.transpose(np.vstack((cat['XWIN_IMAGE'],cat['YWIN_IMAGE'],cat['FLUX_ISO'])))
 
+# the sep background of consecutive guide frames of the same field barely
+# changes, so it is reused. It's remeasured every interval frames, when the
+# frame shape changes, or when the median (of every step-th pixel) moves by
+# more than tolerance (fractional). Each frame is copied into a reusable
+# float32 buffer and the background is subtracted from it in place
+class background_cache:
+
+    def __init__(self, interval=10, tolerance=0.05, step=16, bw=64, bh=64, fw=3, fh=3):
+        self.interval = interval
+        self.tolerance = tolerance
+        self.step = step
+        self.bw = bw
+        self.bh = bh
+        self.fw = fw
+        self.fh = fh
+        self.buffer = None
+        self.reset()
+
+    # force the background to be remeasured on the next frame (e.g., the ROI moved)
+    def reset(self):
+        self.bkg = None
+        self.median = None
+        self.nframes = 0
+
+    # returns the background-subtracted frame (the reused buffer) and the global rms
+    def subtract(self, image):
+
+        if self.buffer is None or self.buffer.shape != image.shape:
+            self.buffer = np.empty(image.shape, dtype=np.float32)
+            self.reset()
+        np.copyto(self.buffer, image, casting='unsafe')
+
+        median = np.median(self.buffer[::self.step,::self.step])
+        if self.bkg is None or (self.nframes % self.interval) == 0 or \
+           abs(median-self.median) > self.tolerance*abs(self.median):
+            self.bkg = sep.Background(self.buffer, bw=self.bw, bh=self.bh, fw=self.fw, fh=self.fh)
+            self.median = median
+            self.nframes = 0
+        self.nframes += 1
+
+        self.bkg.subfrom(self.buffer)
+        return self.buffer, self.bkg.globalrms
+
 # sep wraps the core C source extractor functions in python
 # assuming we can use it correctly,
 # this is going to be faster, more general, and just as good as get_stars_sex
-def get_stars_sep(image, filename=None):
+# background - a background_cache to reuse the background between frames
+def get_stars_sep(image, filename=None, background=None):
     if filename != None:
         image = pyfits.getdata(filename)
 
-    image0 = image.astype('float64')
-        
-    bkg = sep.Background(image0, bw=64, bh=64, fw=3, fh=3)
-#    bkg_rms = bkg.rms()
-    data_sub = image0 - bkg
-    stars = sep.extract(data_sub, 3.0, err=bkg.globalrms, minarea=100)
+    if background == None: background = background_cache(interval=1)
+    data_sub,globalrms = background.subtract(image)
+    stars = sep.extract(data_sub, 3.0, err=globalrms, minarea=100)
     return np.transpose(np.vstack((stars['x'],stars['y'],stars['flux'])))
 
 # use dao to identify stars
@@ -0,0 +1,109 @@
+import numpy as np
+import threading
+import time
+import pyds9
+from pipeline import latest_queue
+
+'''
+shows guider images in a viewer (DS9 by default) from a background thread,
+so the guide loop never waits on the display
+publish only takes (a copy of) at most rate images per second, dropping
+the rest, and the display thread sends the latest one
+logger - the logger
+rate - the maximum number of images per second to send to the viewer
+downsample - average downsample x downsample pixel blocks before sending
+stretch - if True, send an 8 bit image scaled between the 0.5 and 99.5th
+          percentiles (of every 4th pixel along each axis, a sixteenth of the data), instead of the raw 16 bit image
+viewer - a function that shows an image; default: DS9 (via XPA)
+check_interval - how often (seconds) to look for a running DS9; while there
+                 isn't one, publish does nothing
+latency - a latency.latency_log to record the 'display' stage in
+'''
+class display_publisher:
+
+    def __init__(self, logger, rate=2.0, downsample=1, stretch=False, viewer=None, check_interval=5.0, latency=None):
+        self.logger = logger
+        self.rate = rate
+        self.downsample = downsample
+        self.stretch = stretch
+        self.viewer = viewer
+        self.check_interval = check_interval
+        self.latency = latency
+        self.slot = latest_queue(maxsize=1)
+        self.ds9 = None
+        self.tnext = 0.0
+
+        # with a custom viewer, it's always attached
+        self.attached = viewer != None
+        self.nsent = 0
+
+        thread = threading.Thread(target=self.run)
+        thread.name = 'display_thread'
+        thread.daemon = True
+        thread.start()
+
+    # show image (frame number) when the display gets to it
+    # the display gets its own copy (the image may be a camera buffer that
+    # is reused), so only the images it will have time to show are taken
+    def publish(self, image, number=0):
+        if not self.attached: return
+        now = time.monotonic()
+        if now < self.tnext: return
+        self.tnext = now + 1.0/self.rate
+        self.slot.put((image.copy(), number))
+
+    # the image to send to the viewer
+    def prepare(self, image):
+        n = self.downsample
+        if n > 1:
+            ylen,xlen = image.shape
+            ylen -= ylen % n
+            xlen -= xlen % n
+            image = image[0:ylen,0:xlen].reshape(ylen//n, n, xlen//n, n).mean(axis=(1,3), dtype=np.float32)
+        if self.stretch:
+            low,high = np.percentile(image[::4,::4], (0.5,99.5))
+            scale = 255.0/max(high-low, 1.0)
+            image = np.clip((image-low)*scale, 0, 255).astype(np.uint8)
+        return image
+
+    # is there a DS9 to show images in?
+    def find_ds9(self):
+        if pyds9.ds9_targets() == None:
+            self.ds9 = None
+            return False
+        if self.ds9 == None: self.ds9 = pyds9.DS9()
+        return True
+
+    def run(self):
+        tcheck = 0.0
+        tsent = 0.0
+        while True:
+            # without a viewer, look for DS9 every so often
+            if self.viewer == None and time.monotonic() - tcheck > self.check_interval:
+                tcheck = time.monotonic()
+                try: self.attached = self.find_ds9()
+                except:
+                    self.logger.exception("Error connecting to DS9")
+                    self.attached = False
+
+            item = self.slot.get(timeout=self.check_interval)
+            if item == None: continue
+
+            # rate limit
+            wait = 1.0/self.rate - (time.monotonic() - tsent)
+            if wait > 0:
+                time.sleep(wait)
+                newer = self.slot.get(timeout=0)
+                if newer != None: item = newer
+
+            image,number = item
+            tsent = time.monotonic()
+            try:
+                image = self.prepare(image)
+                if self.viewer != None: self.viewer(image)
+                elif self.ds9 != None: self.ds9.set_np2arr(image)
+                self.nsent += 1
+            except:
+                self.logger.exception("Error displaying the image")
+                if self.viewer == None: self.attached = False
+            if self.latency != None: self.latency.record(number, 'display', tsent, time.monotonic())
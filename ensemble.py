@@ -0,0 +1,81 @@
+import numpy as np
+import math
+from scipy.spatial import cKDTree
+
+'''
+ensemble guiding: use every star in the field, not just the guide star,
+to measure how the field moved since a reference frame. Averaging over
+several stars lowers the noise of each correction
+positions are (N,3) arrays of x, y, flux, as returned by imager.get_stars
+'''
+
+# match each detection to the nearest reference star within tolerance (pixels)
+# after shifting the reference by initial=(dx,dy). Each reference star is
+# used at most once (by its closest detection)
+# returns the indices of the matched detections and reference stars
+def match_stars(stars, reference, tolerance, initial=(0.0,0.0)):
+
+    if len(stars) == 0 or len(reference) == 0:
+        return np.zeros(0,dtype=int), np.zeros(0,dtype=int)
+
+    tree = cKDTree(reference[:,0:2] + np.asarray(initial)[None,:])
+    dist,ref_ndx = tree.query(stars[:,0:2], distance_upper_bound=tolerance)
+    star_ndx = np.flatnonzero(np.isfinite(dist))
+    ref_ndx = ref_ndx[star_ndx]
+    dist = dist[star_ndx]
+
+    # one to one: keep the closest detection for each reference star
+    order = np.argsort(dist)
+    ref_ndx, first = np.unique(ref_ndx[order], return_index=True)
+    star_ndx = star_ndx[order][first]
+    return star_ndx, ref_ndx
+
+# the weighted shift (and, optionally, rotation about the weighted center of
+# the reference) that best maps the reference positions onto the star
+# positions, rejecting matches more than clip robust sigma from the solution
+# weights default to sqrt(flux) of the stars
+# returns (dx, dy, theta, xcenter, ycenter, nused, rms) or None
+def solve_transform(stars, reference, weights=None, rotation=False, clip=3.0, niter=3):
+
+    if weights is None: weights = np.sqrt(np.clip(stars[:,2], 0.0, None))
+    good = weights > 0
+    if np.sum(good) < (2 if rotation else 1): return None
+
+    x,y = stars[:,0],stars[:,1]
+    xr,yr = reference[:,0],reference[:,1]
+    for ii in range(niter):
+        w = weights*good
+        wsum = np.sum(w)
+        xc = np.dot(w,xr)/wsum
+        yc = np.dot(w,yr)/wsum
+        xm = np.dot(w,x)/wsum
+        ym = np.dot(w,y)/wsum
+
+        # the rotation that best aligns the centered positions (2-D Procrustes)
+        if rotation:
+            ax,ay = xr-xc,yr-yc
+            bx,by = x-xm,y-ym
+            theta = math.atan2(np.dot(w,ax*by-ay*bx), np.dot(w,ax*bx+ay*by))
+        else: theta = 0.0
+        dx = xm - xc
+        dy = ym - yc
+
+        # reject outliers
+        xmodel,ymodel = apply_transform((dx,dy,theta,xc,yc), xr, yr)
+        resid = np.hypot(x-xmodel, y-ymodel)
+        sigma = 1.4826*np.median(resid[good])
+        if sigma <= 0.0: break
+        newgood = good & (resid < clip*sigma + 1e-3)
+        if np.sum(newgood) < (2 if rotation else 1) or np.array_equal(newgood,good): break
+        good = newgood
+
+    rms = math.sqrt(np.dot(w,resid*resid)/wsum)
+    return (dx, dy, theta, xc, yc, int(np.sum(good)), rms)
+
+# where the reference position (x,y) is, given a transform from solve_transform
+def apply_transform(transform, x, y):
+    dx,dy,theta,xc,yc = transform[0:5]
+    c = math.cos(theta)
+    s = math.sin(theta)
+    return (xc + c*(x-xc) - s*(y-yc) + dx,
+            yc + s*(x-xc) + c*(y-yc) + dy)
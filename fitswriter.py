@@ -0,0 +1,107 @@
+from astropy.io import fits
+import threading
+import queue
+import time
+
+'''
+writes FITS files in a small pool of background threads, so the guide loop
+never waits on the disk
+the images are not copied: once submitted, the writer owns them and the
+caller must not change them
+nworkers - the number of writer threads
+maxsize - the number of images that can wait to be written
+compress - if True, write tile compressed (RICE) images
+policy - what to do when maxsize images are already waiting:
+         'drop' - don't save the new image
+         'block' - wait for room in the queue
+latency - a latency.latency_log to record the 'save' stage in
+'''
+class fits_writer:
+
+    def __init__(self, logger, nworkers=2, maxsize=8, compress=False, policy='drop', latency=None):
+
+        if policy not in ['drop','block']:
+            raise ValueError("policy must be 'drop' or 'block', not " + str(policy))
+
+        self.logger = logger
+        self.compress = compress
+        self.policy = policy
+        self.latency = latency
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.lock = threading.Lock()
+        self.nwritten = 0
+        self.ndropped = 0
+        self.nblocked = 0
+        self.nerrors = 0
+
+        self.workers = []
+        for ii in range(nworkers):
+            worker = threading.Thread(target=self.work)
+            worker.name = 'fits_writer_thread_' + str(ii)
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    # queue image (with header hdr) to be written to filename
+    # number is the frame number (for the latency log)
+    # returns False if it was dropped
+    def submit(self, filename, image, hdr=None, overwrite=False, number=0):
+        item = (filename, image, hdr, overwrite, number)
+        try:
+            self.queue.put_nowait(item)
+            return True
+        except queue.Full:
+            if self.policy == 'drop':
+                self.drop(filename, "FITS writer is behind")
+                return False
+            with self.lock: self.nblocked += 1
+            self.queue.put(item)
+            return True
+
+    # count an image that won't be saved (and why)
+    def drop(self, filename, reason):
+        with self.lock: self.ndropped += 1
+        self.logger.warning(reason + "; not saving " + filename)
+
+    def work(self):
+        while True:
+            item = self.queue.get()
+            if item == None:
+                self.queue.task_done()
+                return
+            filename,image,hdr,overwrite,number = item
+            t0 = time.monotonic()
+            try:
+                self.write(filename, image, hdr=hdr, overwrite=overwrite)
+                with self.lock: self.nwritten += 1
+            except:
+                with self.lock: self.nerrors += 1
+                self.logger.exception("Error writing " + filename)
+            finally:
+                self.queue.task_done()
+            if self.latency != None: self.latency.record(number, 'save', t0, time.monotonic())
+
+    def write(self, filename, image, hdr=None, overwrite=False):
+        self.logger.info("Saving " + filename)
+        if self.compress:
+            hdulist = fits.HDUList([fits.PrimaryHDU(), fits.CompImageHDU(image, header=hdr, compression_type='RICE_1')])
+        else:
+            hdulist = fits.HDUList([fits.PrimaryHDU(image, header=hdr)])
+        hdulist.writeto(filename, overwrite=overwrite)
+
+    # counts for telemetry
+    def stats(self):
+        with self.lock:
+            return {'save_queue':self.queue.qsize(), 'save_written':self.nwritten,
+                    'save_dropped':self.ndropped, 'save_blocked':self.nblocked,
+                    'save_errors':self.nerrors, 'save_policy':self.policy}
+
+    # wait for everything queued so far to be written
+    def flush(self):
+        self.queue.join()
+
+    # wait for everything queued to be written and stop the workers
+    def close(self):
+        for worker in self.workers: self.queue.put(None)
+        for worker in self.workers: worker.join()
+        self.workers = []
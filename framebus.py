@@ -0,0 +1,150 @@
+import numpy as np
+import os
+from multiprocessing import shared_memory, resource_tracker
+
+'''
+a ring of guider frames in shared memory, so other processes (GUIs, loggers,
+analysis) can read them without going through redis
+the guide loop creates it (create=True) and publishes every frame; readers
+attach to it by name. Each slot has a small header (frame number, shape,
+dtype, DATE-OBS, ROI) and a sequence number that is odd while the slot is
+being written, so readers can tell when a frame changed under them
+only one process can own a bus: the creator's pid is in the header, and a
+bus left over from a crash (its creator is gone) is replaced, but one that's
+still in use is not
+name - the name of the shared memory
+nslots - the number of frames kept
+slot_bytes - the largest image (bytes) that fits in a slot
+'''
+MAGIC = b'TRESBUS2'
+BUS_DTYPE = np.dtype([('magic','S8'),('nslots','u8'),('slot_bytes','u8'),('count','u8'),('pid','i8')])
+SLOT_DTYPE = np.dtype([('seq','u8'),('count','u8'),('number','i8'),('height','u4'),('width','u4'),
+                       ('dtype','S8'),('dateobs','S26'),('x1','i4'),('x2','i4'),('y1','i4'),('y2','i4')])
+HEADER_BYTES = 128 # room for BUS_DTYPE or SLOT_DTYPE, keeping the images aligned
+
+class frame_bus:
+
+    def __init__(self, name='tres_guider', nslots=8, slot_bytes=2048*2048*2, create=False):
+
+        self.name = name
+        self.create = create
+        if create:
+            size = HEADER_BYTES + nslots*(HEADER_BYTES + slot_bytes)
+            try: self.shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+            except FileExistsError:
+                self.remove_stale(name)
+                self.shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+            self.header = np.ndarray(1, dtype=BUS_DTYPE, buffer=self.shm.buf)[0]
+            self.header['magic'] = MAGIC
+            self.header['pid'] = os.getpid()
+            self.header['nslots'] = nslots
+            self.header['slot_bytes'] = slot_bytes
+            self.header['count'] = 0
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+            # only the creator may remove it (python < 3.13 would on exit)
+            resource_tracker.unregister(self.shm._name, 'shared_memory')
+            self.header = np.ndarray(1, dtype=BUS_DTYPE, buffer=self.shm.buf)[0]
+            if self.header['magic'] != MAGIC:
+                raise ValueError(name + " is not a guider frame bus")
+
+        self.nslots = int(self.header['nslots'])
+        self.slot_bytes = int(self.header['slot_bytes'])
+        self.slots = []
+        for ii in range(self.nslots):
+            offset = HEADER_BYTES + ii*(HEADER_BYTES + self.slot_bytes)
+            slot_header = np.ndarray(1, dtype=SLOT_DTYPE, buffer=self.shm.buf, offset=offset)[0]
+            self.slots.append((slot_header, offset + HEADER_BYTES))
+        if create:
+            for slot_header,offset in self.slots: slot_header['seq'] = 0
+
+    # remove the bus name, if it was left over from a crash
+    # raises RuntimeError if it's still in use (or isn't a guider frame bus)
+    @staticmethod
+    def remove_stale(name):
+        old = shared_memory.SharedMemory(name=name)
+        error = None
+        if old.size < BUS_DTYPE.itemsize:
+            error = name + " is not a guider frame bus"
+        else:
+            header = np.ndarray(1, dtype=BUS_DTYPE, buffer=old.buf)[0]
+            pid = int(header['pid'])
+            if header['magic'] != MAGIC: error = name + " is not a guider frame bus"
+            elif _alive(pid): error = name + " is in use by process " + str(pid)
+            del header
+        old.close()
+        if error != None:
+            # it isn't ours to remove (python < 3.13 would on exit)
+            resource_tracker.unregister(old._name, 'shared_memory')
+            raise RuntimeError(error)
+        old.unlink()
+
+    # the number of frames published so far
+    def count(self):
+        return int(self.header['count'])
+
+    # copy frame (from imager.acquire_frame) into the next slot
+    def publish(self, frame):
+        image = frame['image']
+        if image.nbytes > self.slot_bytes:
+            raise ValueError("image (" + str(image.nbytes) + " bytes) doesn't fit in a slot (" +
+                             str(self.slot_bytes) + " bytes)")
+        count = self.count()
+        slot_header,offset = self.slots[count % self.nslots]
+
+        slot_header['seq'] += 1 # odd: being written
+        np.ndarray(image.shape, dtype=image.dtype, buffer=self.shm.buf, offset=offset)[...] = image
+        slot_header['count'] = count + 1
+        slot_header['number'] = frame['number']
+        slot_header['height'],slot_header['width'] = image.shape
+        slot_header['dtype'] = image.dtype.str.encode()
+        slot_header['dateobs'] = frame['dateobs'].strftime('%Y-%m-%dT%H:%M:%S.%f').encode()
+        slot_header['x1'] = frame['x1']
+        slot_header['x2'] = frame['x2']
+        slot_header['y1'] = frame['y1']
+        slot_header['y2'] = frame['y2']
+        slot_header['seq'] += 1 # even: done
+        self.header['count'] = count + 1
+
+    # read the count-th frame published (default: the latest)
+    # returns (info, image), or None if it isn't there (not published yet,
+    # already overwritten, or being written)
+    # with copy=False, the image is a view of the shared memory: check that
+    # valid(info) is still True after using it
+    def read(self, count=None, copy=True):
+        if count == None: count = self.count()
+        if count < 1: return None
+        slot_header,offset = self.slots[(count-1) % self.nslots]
+
+        seq = int(slot_header['seq'])
+        if seq % 2 == 1 or slot_header['count'] != count: return None
+        info = {'slot':(count-1) % self.nslots, 'seq':seq, 'count':count,
+                'number':int(slot_header['number']),
+                'dateobs':slot_header['dateobs'].decode(),
+                'x1':int(slot_header['x1']), 'x2':int(slot_header['x2']),
+                'y1':int(slot_header['y1']), 'y2':int(slot_header['y2'])}
+        image = np.ndarray((slot_header['height'],slot_header['width']),
+                           dtype=np.dtype(slot_header['dtype'].decode()),
+                           buffer=self.shm.buf, offset=offset)
+        if copy: image = image.copy()
+        if not self.valid(info): return None
+        if not copy: image.flags.writeable = False
+        return info, image
+
+    # is the frame read into info still in its slot?
+    def valid(self, info):
+        return int(self.slots[info['slot']][0]['seq']) == info['seq']
+
+    def close(self):
+        self.header = None
+        self.slots = []
+        self.shm.close()
+        if self.create: self.shm.unlink()
+
+# is process pid running?
+def _alive(pid):
+    if pid <= 0: return False
+    try: os.kill(pid, 0)
+    except ProcessLookupError: return False
+    except PermissionError: return True
+    return True
@@ -0,0 +1,110 @@
+import glob
+import json
+import os
+import re
+import threading
+
+'''
+hands out the index of the next guider image for each object and night
+(objname.yymmdd.guider.NNNN.fits), without scanning the data directory for
+every frame
+the directory is scanned once, at startup. With a manifest, the counters are
+also kept in a small json file in the data directory, so a restart doesn't
+need to rescan (only the files for an object and night that aren't in it are
+looked for, before its first index is handed out). To be crash safe, the
+manifest records a block of reserve indices ahead of what has been handed
+out: after a crash some numbers may be skipped, but none is used twice.
+The next block is reserved when half of the last one is used, and the
+manifest is written by a background thread, so next never waits on the disk
+datapath - the data directory
+manifest - the name of the manifest file in datapath (None for no manifest)
+reserve - how many indices to reserve each time the manifest is written
+'''
+class frame_index:
+
+    def __init__(self, datapath, manifest=None, reserve=100, logger=None):
+        self.datapath = datapath
+        self.reserve = reserve
+        self.logger = logger
+        self.lock = threading.Lock()
+        self.manifest = None
+        if manifest != None and manifest != '':
+            self.manifest = os.path.join(datapath, manifest)
+
+        # wakes the thread that writes the manifest
+        self.dirty = threading.Event()
+
+        # the last index used and the highest index reserved, for each objname.yymmdd
+        self.counters = {}
+        self.reserved = {}
+        if not self.read_manifest(): self.scan()
+
+        if self.manifest != None:
+            thread = threading.Thread(target=self.run)
+            thread.name = 'frame_index_thread'
+            thread.daemon = True
+            thread.start()
+
+    # find the highest index used for each object and night
+    # (or just for key, objname.yymmdd)
+    def scan(self, key=None):
+        pattern = re.compile(r'^(.*)\.(\d{6})\.guider\.(\d+)\.fits$')
+        if key == None: prefix = '*'
+        else: prefix = glob.escape(key)
+        for filename in glob.glob(os.path.join(glob.escape(self.datapath), prefix + '.guider.*.fits')):
+            match = pattern.match(os.path.basename(filename))
+            if match == None: continue
+            found = match.group(1) + '.' + match.group(2)
+            if key != None and found != key: continue
+            self.counters[found] = max(self.counters.get(found,0), int(match.group(3)))
+            self.reserved[found] = max(self.reserved.get(found,0), self.counters[found])
+
+    def read_manifest(self):
+        if self.manifest == None or not os.path.exists(self.manifest): return False
+        try:
+            with open(self.manifest) as f:
+                self.reserved = {key:int(value) for key,value in json.load(f).items()}
+        except:
+            if self.logger != None: self.logger.exception("Error reading " + self.manifest + "; rescanning")
+            return False
+        # we don't know how many of the reserved indices were used
+        self.counters = dict(self.reserved)
+        return True
+
+    # write the manifest atomically (a crash leaves the old one or the new one)
+    def write_manifest(self):
+        tmpfile = self.manifest + '.tmp'
+        with self.lock: reserved = dict(self.reserved)
+        try:
+            with open(tmpfile,'w') as f:
+                json.dump(reserved, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmpfile, self.manifest)
+        except:
+            if self.logger != None: self.logger.exception("Error writing " + self.manifest)
+
+    def run(self):
+        while True:
+            self.dirty.wait()
+            self.dirty.clear()
+            self.write_manifest()
+
+    # write the manifest now, if it's out of date (e.g., when shutting down)
+    def flush(self):
+        if self.manifest == None or not self.dirty.is_set(): return
+        self.dirty.clear()
+        self.write_manifest()
+
+    # the next index for objname on the night datestr (yymmdd)
+    def next(self, objname, datestr):
+        key = objname + '.' + datestr
+        with self.lock:
+            # not in the manifest; there may be files from before it
+            if key not in self.counters: self.scan(key)
+            index = self.counters.get(key,0) + 1
+            self.counters[key] = index
+            if self.manifest != None and index > self.reserved.get(key,0) - self.reserve//2:
+                self.reserved[key] = max(self.reserved.get(key,0), index) + self.reserve - 1
+                self.dirty.set()
+        return index
@@ -9,6 +9,7 @@ import time
 import os
 import numpy as np
 import cv2
+import utils
 
 def threshold_tozero(frame, otsu = False):
     gray = np.round(frame*255.0/65535).astype('uint8')
@@ -29,18 +30,8 @@ def threshold_binary(frame, otsu = False):
         ret, th2 = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY+cv2.THRESH_OTSU )
     return th2
 
-def robust_std(x):
-    y = x.flatten()
-    n = len(y)
-    y.sort()
-    ind_qt1 = int(round((n+1)/4.))
-    ind_qt3 = int(round((n+1)*3/4.))
-    IQR = y[ind_qt3]- y[ind_qt1]
-    lowFense = y[ind_qt1] - 1.5*IQR
-    highFense = y[ind_qt3] + 1.5*IQR
-    ok = (y>lowFense)*(y<highFense)
-    yy=y[ok]
-    return yy.std(dtype='double')
+def robust_std(x, step=1):
+    return utils.robust_stats(x, step=step)[3]
 
 def threshold_robust(frame, otsu = False):
     gray = np.round(frame*255.0/65535).astype('uint8')
@@ -51,9 +42,9 @@ def threshold_robust(frame, otsu = False):
         ret, th2 = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY+cv2.THRESH_OTSU )
     return th2
 
-def threshold_pyguide(image,level =3):
-    stddev = robust_std(image)
-    median = np.median(image)
+# step - see utils.robust_stats
+def threshold_pyguide(image,level =3, step=1):
+    median,q1,q3,stddev = utils.robust_stats(image, step=step)
     goodpix = image>median+stddev*level
     return goodpix
 
@@ -78,25 +69,41 @@ def centroid_brightest_blob(thresholded_image):
         cx,cy = (M['m10']/M['m00']), (M['m01']/M['m00'])
         return (cx, cy)
 
-def centroid_all_blobs(thresholded_image, areacutoff=30):
-    thresholded_copy = thresholded_image.copy()
-    contours,hierarchy = cv2.findContours(thresholded_copy,
-                                        cv2.RETR_LIST,
-                                        cv2.CHAIN_APPROX_SIMPLE)
-    if len(contours)==0:
-        return []#np.zeros((1, 3)) 
-    
+# finds every blob (8-connected group of nonzero pixels) larger than areacutoff pixels
+# returns (x, y, area) of each, or (x, y, total intensity) if weighted,
+# from connected components, so it's linear in the number of pixels and blobs
+def centroid_all_blobs(thresholded_image, areacutoff=30, weighted=False):
+    # any nonzero 8 bit pixel is foreground; label 0 is the background
+    if thresholded_image.dtype == np.uint8: binary = thresholded_image
+    else: binary = (thresholded_image > 0).astype(np.uint8)
+    nlabels,labels,stats,centroids = cv2.connectedComponentsWithStats(binary, connectivity=8)
+    if nlabels < 2:
+        return []#np.zeros((1, 3))
+
+    area = stats[1:,cv2.CC_STAT_AREA]
+    keep = np.flatnonzero(area >= areacutoff)
+
+    if weighted:
+        # intensity weighted moments of every blob in one pass
+        ylen,xlen = thresholded_image.shape
+        w = thresholded_image.astype(np.float64)
+        lab = labels.ravel()
+        m00 = np.bincount(lab, weights=w.ravel(), minlength=nlabels)[1:]
+        m10 = np.bincount(lab, weights=(w*np.arange(xlen)[None,:]).ravel(), minlength=nlabels)[1:]
+        m01 = np.bincount(lab, weights=(w*np.arange(ylen)[:,None]).ravel(), minlength=nlabels)[1:]
+        cx = m10/np.maximum(m00,1e-30)
+        cy = m01/np.maximum(m00,1e-30)
+        ssum = m00
     else:
-        outarray = np.zeros((1, 3))
-        counter = 0
-        for cnt in contours:
-            M = cv2.moments(cnt)
-            if M['m00']<areacutoff:
-                counter = counter+1
-                continue
-            cx,cy,ssum = (M['m10']/M['m00']), (M['m01']/M['m00']), M['m00']
-            outarray=np.vstack((outarray, np.array((cx, cy, ssum))))
-    return outarray[1:,:]
+        cx = centroids[1:,0]
+        cy = centroids[1:,1]
+        ssum = area
+
+    outarray = np.empty((len(keep),3))
+    outarray[:,0] = cx[keep]
+    outarray[:,1] = cy[keep]
+    outarray[:,2] = ssum[keep]
+    return outarray
  
 if __name__ == "__main__":
 
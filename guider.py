@@ -3,7 +3,8 @@ from astropy.io import fits
 from pyAndorSDK3 import AndorSDK3
 import numpy as np
 import socket
-import os, sys
+import os, sys, time
+import collections
 import utils
 from configobj import ConfigObj
 import ipdb
@@ -18,6 +19,12 @@ import struct
 import pyds9
 import pdu
 import centroid
+import annulus
+import latency
+import fitswriter
+import frameindex
+import framebus
+import threading
 
 class imager:
 
@@ -50,6 +57,7 @@ class imager:
         self.datapath = config['DATAPATH']
         self.x_science_fiber = float(config['XSCIFIB'])
         self.y_science_fiber = float(config['YSCIFIB'])
+        self.stampsize = int(config['STAMPSIZE'])
         self.x_sky_fiber = None
         self.y_sky_fiber = None
         self.dateobs = ''
@@ -64,6 +72,52 @@ class imager:
         self.guiding = False
         self.simulate=simulate
 
+        # warm starts the annulus fit from frame to frame
+        self.annulus_tracker = annulus.annulus_tracker()
+
+        # picks the annulus centroider for each frame
+        # (its bias tables are built now, for the stamp around the fiber)
+        self.scheduler = centroid.centroid_scheduler(logger=self.logger, tracker=self.annulus_tracker,
+                                                     shape=(self.stampsize,self.stampsize),
+                                                     x_hole=self.stampsize//2 + self.x_science_fiber % 1.0,
+                                                     y_hole=self.stampsize//2 + self.y_science_fiber % 1.0)
+
+        # reuses the sky background between frames
+        self.background = centroid.background_cache()
+
+        # how long each stage of the guide loop takes (see latency.latency_log)
+        self.latency = latency.latency_log()
+        self.nframes = 0  # the number of frames taken
+        self.framenum = 0 # the number of the frame in self.image
+
+        # continuous acquisition (see start_streaming)
+        self.streaming = False
+        self.stream_buffers = []
+        self.queued_buffers = collections.deque() # with the camera, in the order they'll be filled
+        self.held_buffers = set()                 # handed out in frames, not released yet (see release_frame)
+        self.claimed_buffers = set()              # given to the FITS writer (see claim_frame)
+        self.stream_lock = threading.Lock()
+        self.loaded_frame = None                  # the frame in self.image (see load_frame)
+
+        # saves frames in the background (see fitswriter.fits_writer)
+        self.writer = fitswriter.fits_writer(self.logger,
+                                             nworkers=int(config.get('SAVE_WORKERS',2)),
+                                             maxsize=int(config.get('SAVE_QUEUE',8)),
+                                             compress=(str(config.get('SAVE_COMPRESS','False')) == 'True'),
+                                             policy=config.get('SAVE_POLICY','drop'),
+                                             latency=self.latency)
+
+        # numbers the saved images (see frameindex.frame_index)
+        self.frame_index = frameindex.frame_index(self.datapath, manifest=config.get('INDEX_MANIFEST'),
+                                                  logger=self.logger)
+
+        # shares the frames with other processes (see framebus.frame_bus)
+        # it's only made when guiding (see open_frame_bus)
+        self.frame_bus = None
+        self.frame_bus_name = config.get('FRAMEBUS_NAME','')
+        self.frame_bus_slots = int(config.get('FRAMEBUS_SLOTS',8))
+        self.frame_bus_bytes = int(config['XPIX'])*int(config['YPIX'])*2
+
 #        self.redis.set('gain',self.gain)
 #        self.redis.set('x_science_fiber',self.x_science_fiber)
 #        self.redis.set('y_science_fiber',self.y_science_fiber)
@@ -98,9 +152,12 @@ class imager:
 #        self.redis.set('Dband',self.Dband)
 #        self.redis.set('Corr_max',self.Corr_max)
         
+        # the region of the chip the camera reads out (x1,x2,y1,y2,binning)
+        self.aoi = None
         if not self.simulate:
             sdk3 = AndorSDK3()
             self.imager = sdk3.cameras[0].camera()
+            self.set_aoi()
 
     ''' 
     this creates a simple simulated image of a star field
@@ -113,14 +170,22 @@ class imager:
     noise -- readnoise of the image
     '''
     def simulate_star_image(self,x,y,flux,fwhm,background=300.0,noise=0.0):
+        self.load_frame(self.simulate_frame(x,y,flux,fwhm,background=background,noise=noise))
+
+    # same as simulate_star_image, but returns the frame (see acquire_frame)
+    # instead of loading it
+    def simulate_frame(self,x,y,flux,fwhm,background=300.0,noise=0.0):
 
-        self.dateobs = datetime.datetime.utcnow()
-#        self.redis.set('dateobs',self.dateobs.strftime('%Y-%m-%dT%H:%M:%S.%f'))
+        frame = {'dateobs':datetime.datetime.utcnow(), 'exptime':self.exptime,
+                 'x1':self.x1, 'x2':self.x2, 'y1':self.y1, 'y2':self.y2,
+                 'tstart':time.monotonic(), 'number':self.nframes}
+        self.nframes += 1
+#        self.redis.set('dateobs',frame['dateobs'].strftime('%Y-%m-%dT%H:%M:%S.%f'))
         
 
-        xwidth = self.x2-self.x1
-        ywidth = self.y2-self.y1
-        self.image = np.zeros((ywidth,xwidth),dtype=np.float64) + background + np.random.normal(scale=noise,size=(ywidth,xwidth))
+        xwidth = self.x2-self.x1+1
+        ywidth = self.y2-self.y1+1
+        image = np.zeros((ywidth,xwidth),dtype=np.float64) + background + np.random.normal(scale=noise,size=(ywidth,xwidth))
         
         # add a guide star?
         sigma = fwhm/self.platescale
@@ -139,8 +204,9 @@ class imager:
         # add each of the stars
         for ii in range(len(x)):
 
-            xii = x[ii]-self.x1+1
-            yii = y[ii]-self.y1+1
+            # index of the pixel in the image (the ROI starts at detector pixel x1,y1)
+            xii = x[ii]-self.x1
+            yii = y[ii]-self.y1
             
             # make sure the stamp fits on the image (if not, truncate the stamp)
             if xii >= boxsize:
@@ -177,72 +243,380 @@ class imager:
                 noisystar = (star + np.sqrt(star)*noise)/self.gain                
 
                 # add the star to the image
-                self.image[y1:y2,x1:x2] += noisystar
+                image[y1:y2,x1:x2] += noisystar
             else: self.logger.warning("star off image (" + str(xii) + "," + str(yii) + "); ignoring")
                 
-        # now convert to 16 bit int
-        self.image = self.image.astype(np.int16)
-        h, w = self.image.shape
+        # now convert to 16 bit unsigned int, like the camera (saturating instead of wrapping)
+        frame['image'] = np.clip(image, 0, 65535).astype(np.uint16)
+        frame['tend'] = time.monotonic()
+        h, w = frame['image'].shape
         shape = struct.pack('>II',h,w)
-        encoded_img = shape + self.image.tobytes()
+        encoded_img = shape + frame['image'].tobytes()
 #        self.redis.publish('guider_image',encoded_img)
+        return frame
 
     # this currently has ~0.5s of overhead
     def take_image(self, exptime):
+        self.load_frame(self.acquire_frame(exptime))
+
+    # take an image without touching self.image, so it can run in another
+    # thread while the last frame is being centroided
+    # returns a frame: a dict with the image, its dateobs, exptime, and ROI,
+    # and when the exposure started and ended (time.monotonic())
+    def acquire_frame(self, exptime):
+
+        if self.streaming: return self.next_frame()
 
         self.exptime = exptime
 #        self.redis.set('exptime',self.exptime)
         
-        self.imager.ExposureTime = self.exptime
-        self.dateobs = datetime.datetime.utcnow()
-#        self.redis.set('dateobs',self.dateobs.strftime('%Y-%m-%dT%H:%M:%S.%f'))
+        self.imager.ExposureTime = exptime
+        frame = {'dateobs':datetime.datetime.utcnow(), 'exptime':exptime,
+                 'x1':self.x1, 'x2':self.x2, 'y1':self.y1, 'y2':self.y2,
+                 'number':self.nframes}
+        self.nframes += 1
+#        self.redis.set('dateobs',frame['dateobs'].strftime('%Y-%m-%dT%H:%M:%S.%f'))
         
-        t0 = datetime.datetime.utcnow()
-        self.image = (self.imager.acquire(timeout=20000).image.astype(np.int16))[self.y1:self.y2,self.x1:self.x2]
-        self.logger.info("image done in " + str((datetime.datetime.utcnow() - t0).total_seconds()))
+        t0 = time.monotonic()
+        # keep the camera's native 16 bit unsigned data (int16 wraps above 32767 ADU)
+        image = self.imager.acquire(timeout=20000).image
+        frame['tend'] = time.monotonic()
+        self.latency.record(frame['number'], 'acquire', t0, frame['tend'])
+        with self.latency.timer(frame['number'], 'crop'):
+            frame['image'] = self.crop(image, frame['x1'],frame['x2'],frame['y1'],frame['y2'])
+        # the overhead is mostly before the exposure
+        frame['tstart'] = max(t0, frame['tend'] - exptime)
+        self.logger.info("image done in " + str(frame['tend'] - t0))
+        return frame
+
+    '''
+    keep the camera exposing continuously into a ring of nbuffers
+    preallocated buffers, instead of paying the arm/start/stop overhead of
+    acquire for every frame. Get the frames with next_frame (or
+    acquire_frame), release each one when done with it (see release_frame),
+    and call stop_streaming when done
+    '''
+    def start_streaming(self, exptime, nbuffers=10):
+
+        if self.streaming: self.stop_streaming()
+
+        self.exptime = exptime
+        self.imager.ExposureTime = exptime
+        self.imager.PixelEncoding = 'Mono16'
+        self.imager.TriggerMode = 'Internal'
+        self.imager.CycleMode = 'Continuous'
+
+        # the SDK fills the queued buffers in order, so we can keep our
+        # own (zero copy) views of them
+        self.stream_size = self.imager.ImageSizeBytes
+        self.stream_shape = (self.imager.AOIHeight, self.imager.AOIWidth)
+        self.stream_stride = self.imager.AOIStride
+        self.stream_buffers = [np.empty(self.stream_size, dtype=np.uint8) for ii in range(nbuffers)]
+        self.queued_buffers.clear()
+        self.held_buffers.clear()
+        self.claimed_buffers.clear()
+        self.loaded_frame = None
+        for ndx in range(nbuffers):
+            self.imager.queue(self.stream_buffers[ndx], self.stream_size)
+            self.queued_buffers.append(ndx)
+
+        self.imager.AcquisitionStart()
+        self.streaming = True
+        self.logger.info("Streaming " + str(exptime) + " second exposures into " + str(nbuffers) + " buffers")
+
+    def stop_streaming(self):
+        if not self.streaming: return
+        with self.stream_lock:
+            self.imager.AcquisitionStop()
+            self.imager.flush()
+            self.queued_buffers.clear()
+            self.held_buffers.clear()
+            self.streaming = False
+
+    # the next frame from the stream (see acquire_frame). The image is a
+    # view of the ring buffer, not a copy: the buffer isn't given back to the
+    # camera until the frame is released (release_frame, or loading the next
+    # frame with load_frame), so every frame taken must be released. If they
+    # aren't released fast enough, the camera runs out of buffers and waits
+    def next_frame(self, timeout=20000):
+
+        t0 = time.monotonic()
+        self.imager.wait_buffer(timeout)
+        tend = time.monotonic()
+        with self.stream_lock:
+            ndx = self.queued_buffers.popleft()
+            self.held_buffers.add(ndx)
+
+        frame = {'dateobs':datetime.datetime.utcnow() - datetime.timedelta(seconds=self.exptime),
+                 'exptime':self.exptime, 'x1':self.x1, 'x2':self.x2, 'y1':self.y1, 'y2':self.y2,
+                 'number':self.nframes, 'buffer':ndx, 'tstart':tend - self.exptime, 'tend':tend}
+        self.nframes += 1
+        self.latency.record(frame['number'], 'acquire', t0, tend)
+
+        with self.latency.timer(frame['number'], 'crop'):
+            image = np.ndarray(self.stream_shape, dtype=np.uint16, buffer=self.stream_buffers[ndx],
+                               strides=(self.stream_stride, 2))
+            frame['image'] = self.crop(image, frame['x1'],frame['x2'],frame['y1'],frame['y2'])
+        return frame
+
+    # give the buffer of frame (from next_frame) back to the camera. The
+    # frame's image must not be used after this (unless the FITS writer
+    # claimed it; see claim_frame). Frames not from the stream are ignored
+    def release_frame(self, frame):
+        if frame == None or 'buffer' not in frame: return
+        ndx = frame['buffer']
+        with self.stream_lock:
+            if not self.streaming or ndx not in self.held_buffers or \
+               not np.shares_memory(frame['image'], self.stream_buffers[ndx]): return
+            self.held_buffers.discard(ndx)
+            # a buffer the FITS writer took is replaced with a new one
+            if ndx in self.claimed_buffers:
+                self.claimed_buffers.discard(ndx)
+                self.stream_buffers[ndx] = np.empty(self.stream_size, dtype=np.uint8)
+            self.imager.queue(self.stream_buffers[ndx], self.stream_size)
+            self.queued_buffers.append(ndx)
+
+    # make frame (from acquire_frame or simulate_frame) the current image,
+    # releasing the last one (see release_frame)
+    # (it only updates the ROI bookkeeping to match the frame; the camera isn't re-armed)
+    def load_frame(self, frame):
+        if self.loaded_frame is not frame: self.release_frame(self.loaded_frame)
+        self.loaded_frame = frame
+        roi = (frame['x1'],frame['x2'],frame['y1'],frame['y2'])
+        if roi != (self.x1,self.x2,self.y1,self.y2):
+            self.background.reset()
+            self.x1,self.x2,self.y1,self.y2 = roi
+        self.image = frame['image']
+        self.dateobs = frame['dateobs']
+        self.exptime = frame['exptime']
+        self.framenum = frame['number']
 
     def save_image(self, filename, overwrite=False, hdr=None):
 
+        with self.latency.timer(self.framenum, 'save'):
+            self._save_image(filename, overwrite=overwrite, hdr=hdr)
+
+    def _save_image(self, filename, overwrite=False, hdr=None):
+
         self.logger.info("Saving " + filename)
         # make a minimal header if not supplied
         if hdr==None: hdr = fits.Header()
 
         # update a few things that might change
-        hdr['DATE-OBS'] = (self.dateobs.strftime('%Y-%m-%dT%H:%M:%S.%f'),'YYYY-MM-DDThh:mm:ss.ssssss (UTC)')
-        hdr['EXPTIME'] = (self.exptime,'Exposure time (s)')
-        datasec = '[' + str(self.x1) + ':' + str(self.x2) + ',' + str(self.y1) + ':' + str(self.y2) + ']'
-        hdr['DATASEC'] = (datasec,"Region of CCD read")
-        hdr['CCDSUM'] = (str(self.xbin) + ' ' + str(self.ybin),'CCD on-chip summing')
+        self.update_header(hdr)
         
         # save the image and header
         hdu = fits.PrimaryHDU(self.image, header=hdr)
         hdulist = fits.HDUList([hdu])
         hdulist.writeto(filename, overwrite=overwrite)
         
+    # fill in the keywords that change from frame to frame, for frame
+    # (default: the current image)
+    def update_header(self, hdr, frame=None):
+        if frame == None:
+            frame = {'dateobs':self.dateobs, 'exptime':self.exptime,
+                     'x1':self.x1, 'x2':self.x2, 'y1':self.y1, 'y2':self.y2}
+        hdr['DATE-OBS'] = (frame['dateobs'].strftime('%Y-%m-%dT%H:%M:%S.%f'),'YYYY-MM-DDThh:mm:ss.ssssss (UTC)')
+        hdr['EXPTIME'] = (frame['exptime'],'Exposure time (s)')
+        datasec = '[' + str(frame['x1']) + ':' + str(frame['x2']) + ',' + str(frame['y1']) + ':' + str(frame['y2']) + ']'
+        hdr['DATASEC'] = (datasec,"Region of CCD read")
+        hdr['CCDSUM'] = (str(self.xbin) + ' ' + str(self.ybin),'CCD on-chip summing')
+        return hdr
+
+    # save frame (from acquire_frame or simulate_frame) in the background
+    # returns False if it wasn't saved: the writer was too far behind to take
+    # it, or the frame was already released (its pixels may be another frame's)
+    def save_frame(self, filename, frame, hdr=None, overwrite=False):
+        if not self.claim_frame(frame):
+            self.writer.drop(filename, "frame " + str(frame['number']) + " was already released")
+            return False
+        if hdr == None: hdr = fits.Header()
+        self.update_header(hdr, frame)
+        return self.writer.submit(filename, frame['image'], hdr=hdr, overwrite=overwrite, number=frame['number'])
+
+    # take the image of frame out of the stream's ring buffer, so it won't be
+    # overwritten. Returns False if it's too late (it was released)
+    def claim_frame(self, frame):
+        if 'buffer' not in frame: return True
+        ndx = frame['buffer']
+        with self.stream_lock:
+            if ndx not in self.held_buffers or not np.shares_memory(frame['image'], self.stream_buffers[ndx]):
+                return False
+            self.claimed_buffers.add(ndx)
+        return True
+
     ''' set the region of interest'''
-    # right now, it appears this is not supported on chip in Python
-    # this will read the whole image, but only save the ROI in self.image
-    def set_roi(self,x1,x2,y1,y2):
+    # x1,x2,y1,y2 are the first and last detector pixels (1-indexed,
+    # inclusive, like DATASEC); the image starts at detector pixel (x1,y1)
+    # the camera reads out only the ROI (see set_aoi)
+    # binning - on-chip binning (the same in X and Y). The centroiding assumes 1
+    def set_roi(self,x1,x2,y1,y2,binning=None):
+
+        if binning == None: binning = self.xbin
 
         # boundary checking
-        if x1 < 1 or x1 >= x2 or x2 > 2048 or y1 < 1 or y1 >= y2 or y2 > 2048:
+        if x1 < 1 or x1 >= x2 or x2 > 2048 or y1 < 1 or y1 >= y2 or y2 > 2048 or \
+           (x2-x1+1) % binning != 0 or (y2-y1+1) % binning != 0:
             self.logger.error('Region of interest not allowed')
             return
 
+        # the background cache is for the old ROI
+        if (x1,x2,y1,y2) != (self.x1,self.x2,self.y1,self.y2):
+            self.background.reset()
+
         # set the ROI
         self.x1 = x1
         self.y1 = y1
         self.x2 = x2
         self.y2 = y2
+        self.xbin = binning
+        self.ybin = binning
 #        self.redis.set('x1',self.x1)
 #        self.redis.set('x2',self.x2)
 #        self.redis.set('y1',self.y1)
 #        self.redis.set('y2',self.y2)
 
-    def get_stars(self):
+        if not self.simulate: self.set_aoi()
+
+    # program the camera's AOI to the ROI. The camera must be re-armed for
+    # that, so only do it if it changed. If the camera won't take it, read
+    # the full frame and crop it in software
+    def set_aoi(self):
+
+        aoi = (self.x1,self.x2,self.y1,self.y2,self.xbin)
+        if aoi == self.aoi: return
+
+        streaming = self.streaming
+        if streaming: self.stop_streaming()
+
+        # the order matters: each sets the allowed range of the next
+        try:
+            self.imager.AOIBinning = str(self.xbin) + 'x' + str(self.ybin)
+            self.imager.AOIWidth = (self.x2-self.x1+1)//self.xbin
+            self.imager.AOILeft = self.x1
+            self.imager.AOIHeight = (self.y2-self.y1+1)//self.ybin
+            self.imager.AOITop = self.y1
+            self.aoi = aoi
+        except:
+            self.logger.exception("Could not read out " + str(aoi) + " on chip; reading the full frame")
+            self.imager.AOIBinning = '1x1'
+            self.imager.AOIWidth = 2048
+            self.imager.AOILeft = 1
+            self.imager.AOIHeight = 2048
+            self.imager.AOITop = 1
+            self.aoi = (1,2048,1,2048,1)
+
+        if streaming: self.start_streaming(self.exptime, nbuffers=len(self.stream_buffers))
+
+    # make the frame bus, if it's enabled and not made yet. If another
+    # guider owns it, frames aren't shared
+    def open_frame_bus(self):
+        if self.frame_bus != None or self.frame_bus_name == '': return
+        try:
+            self.frame_bus = framebus.frame_bus(name=self.frame_bus_name, nslots=self.frame_bus_slots,
+                                                slot_bytes=self.frame_bus_bytes, create=True)
+        except:
+            self.logger.exception("Error making the frame bus; not sharing frames")
+
+    def close_frame_bus(self):
+        if self.frame_bus == None: return
+        self.frame_bus.close()
+        self.frame_bus = None
+
+    # the ROI x1..x2, y1..y2 (detector pixels) of an image read out with the
+    # current AOI (a view, not a copy)
+    def crop(self, image, x1, x2, y1, y2):
+        ax1,ax2,ay1,ay2,binning = self.aoi
+        return image[(y1-ay1)//binning:(y2-ay1+1)//binning,(x1-ax1)//binning:(x2-ax1+1)//binning]
+
+    # cut a size x size stamp centered on (x,y) from the image, shifted to stay on the image
+    # returns the stamp and the offset of the stamp in the image
+    def get_stamp(self, x, y, size):
+        ylen,xlen = self.image.shape
+        xs = int(min(max(round(x - size/2.0), 0), max(xlen-size, 0)))
+        ys = int(min(max(round(y - size/2.0), 0), max(ylen-size, 0)))
+        return self.image[ys:ys+size,xs:xs+size], xs, ys
+
+    # the stamp around the science fiber, its offset in the image, and the
+    # fiber position in the image (1-indexed)
+    def fiber_stamp(self):
+        xfiber = self.x_science_fiber - (self.x1 - 1)
+        yfiber = self.y_science_fiber - (self.y1 - 1)
+        stamp,xs,ys = self.get_stamp(xfiber, yfiber, self.stampsize)
+        return stamp,xs,ys,xfiber,yfiber
+
+    # centroid the star in the stamp around the fiber with the scheduled
+    # annulus centroider. Returns [[x,y,flux]] in image coordinates, or []
+    def centroid_fiber_stamp(self, deadline=None):
+        stamp,xs,ys,xfiber,yfiber = self.fiber_stamp()
+        stars = self.scheduler.get_stars(stamp, deadline=deadline,
+                                         x_hole=xfiber-xs, y_hole=yfiber-ys,
+                                         x0=xs+self.x1-1, y0=ys+self.y1-1)
+        if len(stars) == 0: return []
+        stars[:,0] += xs
+        stars[:,1] += ys
+        return stars
+
+    # centroid only a stamp around the predicted position (x,y) of a star
+    # (detector coordinates), instead of searching the whole image
+    # returns [[x,y,flux]] in detector coordinates, or [] if the star isn't there
+    def track_star(self, x, y, deadline=None):
+
+        with self.latency.timer(self.framenum, 'fit'):
+            return self._track_star(x, y, deadline=deadline)
+
+    def _track_star(self, x, y, deadline=None):
+
+        # near the fiber, the hole biases the centroid
+        if math.hypot(x-self.x_science_fiber, y-self.y_science_fiber) < self.stampsize/4.0:
+            stars = self.centroid_fiber_stamp(deadline=deadline)
+        else:
+            xi = x - (self.x1 - 1)
+            yi = y - (self.y1 - 1)
+            stamp,xs,ys = self.get_stamp(xi, yi, self.stampsize)
+            stars = centroid.get_stars_com(stamp, x=xi-xs, y=yi-ys, radius=self.stampsize/2.0)
+            if len(stars) != 0:
+                stars[:,0] += xs
+                stars[:,1] += ys
+        if len(stars) == 0: return []
+
+        stars[:,0] += (self.x1 - 1)
+        stars[:,1] += (self.y1 - 1)
+        return stars
+
+    # find all the stars in the image (detector coordinates, 1-indexed)
+    # the detection runs once on the whole image; only the star in the stamp
+    # around the fiber nearest to the target (default: the science fiber) is
+    # refined by the (slower) annulus centroiders. They assume one star in
+    # the stamp, so any others keep their detected positions
+    # deadline - when the centroid is needed by (time.monotonic()); see centroid.centroid_scheduler
+    def get_stars(self, deadline=None, target=None):
+
+        # stage 1: detection (sep is 0-indexed)
+        with self.latency.timer(self.framenum, 'detect'):
+            stars = centroid.get_stars_sep(self.image, background=self.background)
+        if len(stars) == 0: return []
+        stars[:,0] += 1.0
+        stars[:,1] += 1.0
+
+        # stage 2: refine the candidate in the stamp around the fiber,
+        # where the hole biases the detection (image coordinates)
+        stamp,xs,ys,xfiber,yfiber = self.fiber_stamp()
+        if target == None:
+            xtarget,ytarget = xfiber,yfiber
+        else:
+            xtarget = target[0] - (self.x1 - 1)
+            ytarget = target[1] - (self.y1 - 1)
+        dist = np.hypot(stars[:,0]-xtarget, stars[:,1]-ytarget)
+        ylen,xlen = stamp.shape
+        instamp = np.where((stars[:,0] >= xs+1) & (stars[:,0] <= xs+xlen) &
+                           (stars[:,1] >= ys+1) & (stars[:,1] <= ys+ylen))[0]
+        if len(instamp) > 0:
+            ndx = instamp[np.argmin(dist[instamp])]
+            with self.latency.timer(self.framenum, 'fit'):
+                refined = self.centroid_fiber_stamp(deadline=deadline)
+            if len(refined) != 0: stars[ndx,:] = refined[0,:]
 
-        stars = centroid.get_stars_sep(self.image)
-        stars = centroid.get_stars_model_annulus(self.image)
         stars[:,0] += (self.x1 - 1)
         stars[:,1] += (self.y1 - 1)
         return stars
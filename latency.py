@@ -0,0 +1,78 @@
+import numpy as np
+import threading
+import contextlib
+import time
+
+'''
+records how long each stage of the guide loop takes, for every frame, in a
+fixed-size ring buffer (the oldest records are overwritten)
+times are time.monotonic()
+size - the number of records kept
+'''
+STAGES = ['acquire','crop','detect','fit','pid','tiptilt','display','save']
+LATENCY_DTYPE = np.dtype([('frame','i8'),('stage','u1'),('start','f8'),('end','f8')])
+
+class latency_log:
+
+    def __init__(self, size=8192):
+        self.records = np.zeros(size, dtype=LATENCY_DTYPE)
+        self.count = 0
+        self.lock = threading.Lock()
+
+    # stage ran from start to end while processing frame (frame number)
+    def record(self, frame, stage, start, end):
+        with self.lock:
+            self.records[self.count % len(self.records)] = (frame, STAGES.index(stage), start, end)
+            self.count += 1
+
+    # time the code in the with block as stage of frame
+    @contextlib.contextmanager
+    def timer(self, frame, stage):
+        start = time.monotonic()
+        try: yield
+        finally: self.record(frame, stage, start, time.monotonic())
+
+    # the records still in the buffer, oldest first
+    def get_records(self):
+        with self.lock:
+            n = len(self.records)
+            if self.count <= n: return self.records[0:self.count].copy()
+            ndx = self.count % n
+            return np.concatenate((self.records[ndx:],self.records[0:ndx]))
+
+    # the percentiles of how long stage took (seconds)
+    def percentiles(self, stage, q=(50.0,90.0,99.0)):
+        records = self.get_records()
+        records = records[records['stage'] == STAGES.index(stage)]
+        if len(records) == 0: return np.full(len(q), np.nan)
+        return np.percentile(records['end'] - records['start'], q)
+
+    # the percentiles of the time from the start of the first stage to the
+    # end of the last stage of each frame, e.g., from the exposure to the
+    # tip/tilt correction
+    def frame_percentiles(self, first='acquire', last='tiptilt', q=(50.0,90.0,99.0)):
+        records = self.get_records()
+        starts = records[records['stage'] == STAGES.index(first)]
+        ends = records[records['stage'] == STAGES.index(last)]
+        frames,ndx1,ndx2 = np.intersect1d(starts['frame'], ends['frame'], return_indices=True)
+        if len(frames) == 0: return np.full(len(q), np.nan)
+        return np.percentile(ends['end'][ndx2] - starts['start'][ndx1], q)
+
+    # {stage: percentiles} for every stage that was recorded
+    def summary(self, q=(50.0,90.0,99.0)):
+        summary = {}
+        for stage in STAGES:
+            p = self.percentiles(stage, q=q)
+            if np.all(np.isfinite(p)): summary[stage] = p
+        return summary
+
+    # write the records to filename: a csv file if it ends in .csv,
+    # otherwise a (compact) numpy .npy file
+    def dump(self, filename):
+        records = self.get_records()
+        if filename.endswith('.csv'):
+            with open(filename,'w') as f:
+                f.write('frame,stage,start,end\n')
+                for frame,stage,start,end in records:
+                    f.write('%d,%s,%.6f,%.6f\n' % (frame, STAGES[stage], start, end))
+        else: np.save(filename, records)
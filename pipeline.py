@@ -0,0 +1,80 @@
+import threading
+import collections
+import numpy as np
+
+'''
+helpers for the pipelined guide loop (see tres.guide), where the next
+exposure integrates while the last frame is centroided and the correction
+before it is sent to the tip/tilt
+'''
+
+'''
+a bounded queue that always keeps the newest items: when it is full, putting
+a new item drops the oldest one, so a slow consumer works on the most recent
+frame instead of falling further and further behind
+'''
+class latest_queue:
+
+    def __init__(self, maxsize=1):
+        self.items = collections.deque(maxlen=maxsize)
+        self.condition = threading.Condition()
+        self.dropped = 0
+
+    # add an item; returns the item it displaced (or None)
+    def put(self, item):
+        with self.condition:
+            old = None
+            if len(self.items) == self.items.maxlen:
+                old = self.items.popleft()
+                self.dropped += 1
+            self.items.append(item)
+            self.condition.notify()
+        return old
+
+    # the oldest item, waiting up to timeout seconds; None if there isn't one
+    def get(self, timeout=None):
+        with self.condition:
+            if len(self.items) == 0:
+                self.condition.wait(timeout)
+            if len(self.items) == 0: return None
+            return self.items.popleft()
+
+    def __len__(self):
+        return len(self.items)
+
+'''
+keeps track of the tip/tilt corrections that have been commanded, and when
+each took effect, so the position measured in a frame can be brought up to
+date with the corrections that weren't (fully) in it yet
+times are time.monotonic(); corrections are pixels
+'''
+class correction_log:
+
+    def __init__(self, history=20):
+        self.lock = threading.Lock()
+        # [time applied (None if still pending), dx, dy]
+        self.corrections = collections.deque(maxlen=history)
+
+    # a correction was sent to the actuator; returns its entry
+    def issued(self, dx, dy):
+        entry = [None, dx, dy]
+        with self.lock: self.corrections.append(entry)
+        return entry
+
+    # the actuator finished the move for entry at time t
+    def applied(self, entry, t):
+        with self.lock: entry[0] = t
+
+    # the part of the corrections that happened after an exposure from
+    # tstart to tend started, i.e., what must be added to a position
+    # measured in that exposure to get where the star is now
+    def pending(self, tstart, tend):
+        offset = np.zeros(2)
+        with self.lock:
+            for t,dx,dy in self.corrections:
+                if t is None or t >= tend: fraction = 1.0
+                elif t <= tstart: continue
+                else: fraction = (t-tstart)/(tend-tstart)
+                offset[0] += fraction*dx
+                offset[1] += fraction*dy
+        return offset
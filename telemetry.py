@@ -0,0 +1,131 @@
+import threading
+import time
+import json
+import collections
+
+'''
+publishes telemetry to redis from a background thread, so nothing that
+reports telemetry (e.g., a tip/tilt move) waits on a redis round trip
+set() and publish() only store the values; every interval seconds, the
+thread sends everything new in one redis pipeline: the latest value of each
+key, and every message published on each channel since the last send. If
+redis can't keep up and more than backlog messages are waiting on a
+channel, the oldest are dropped (counted in ncoalesced)
+logger - the logger
+client - a redis client (redis.Redis), or None for a local_redis stand-in
+interval - how often (seconds) to send
+backlog - the most messages kept waiting on each channel
+'''
+class telemetry_publisher:
+
+    def __init__(self, logger, client=None, interval=0.1, backlog=100):
+        self.logger = logger
+        if client == None: client = local_redis()
+        self.client = client
+        self.interval = interval
+        self.backlog = backlog
+        self.lock = threading.Lock()
+        self.values = {}
+        self.messages = {}
+        self.nsent = 0
+        self.ncoalesced = 0
+        self.nerrors = 0
+        self.last_error = 0.0
+
+        thread = threading.Thread(target=self.run)
+        thread.name = 'telemetry_thread'
+        thread.daemon = True
+        thread.start()
+
+    # set key to value (a redis string)
+    def set(self, key, value):
+        with self.lock:
+            if key in self.values: self.ncoalesced += 1
+            self.values[key] = value
+
+    # set several keys at once from a dict
+    def update(self, values):
+        with self.lock:
+            self.ncoalesced += len(self.values.keys() & values.keys())
+            self.values.update(values)
+
+    # publish message (a dict, sent as json) on channel
+    def publish(self, channel, message):
+        with self.lock:
+            if channel not in self.messages: self.messages[channel] = collections.deque(maxlen=self.backlog)
+            if len(self.messages[channel]) == self.backlog: self.ncoalesced += 1
+            self.messages[channel].append(message)
+
+    # send what's new in one round trip
+    def flush(self):
+        with self.lock:
+            values,self.values = self.values,{}
+            messages,self.messages = self.messages,{}
+        if len(values) == 0 and len(messages) == 0: return
+
+        try:
+            pipe = self.client.pipeline(transaction=False)
+            if len(values) > 0: pipe.mset(values)
+            for channel,queued in messages.items():
+                for message in queued: pipe.publish(channel, json.dumps(message))
+            pipe.execute()
+            self.nsent += 1
+        except:
+            # don't flood the log when redis is down
+            self.nerrors += 1
+            if time.monotonic() - self.last_error > 60.0:
+                self.logger.exception("Error sending telemetry (" + str(self.nerrors) + " errors so far)")
+                self.last_error = time.monotonic()
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            self.flush()
+
+'''
+a stand-in for a redis client when there is no server: it keeps the values
+and the recent messages in memory
+'''
+class local_redis:
+
+    def __init__(self, history=100):
+        self.values = {}
+        self.messages = collections.deque(maxlen=history)
+
+    def set(self, key, value):
+        self.values[key] = value
+
+    def mset(self, values):
+        self.values.update(values)
+
+    def publish(self, channel, message):
+        self.messages.append((channel, message))
+
+    def get(self, key):
+        return self.values.get(key)
+
+    def pipeline(self, transaction=False):
+        return local_pipeline(self)
+
+class local_pipeline:
+
+    def __init__(self, client):
+        self.client = client
+        self.commands = []
+
+    def mset(self, values):
+        self.commands.append((self.client.mset, (dict(values),)))
+        return self
+
+    def set(self, key, value):
+        self.commands.append((self.client.set, (key, value)))
+        return self
+
+    def publish(self, channel, message):
+        self.commands.append((self.client.publish, (channel, message)))
+        return self
+
+    def execute(self):
+        results = [command(*args) for command,args in self.commands]
+        self.commands = []
+        return results
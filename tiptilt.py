@@ -10,11 +10,12 @@ import numpy as np
 import argparse
 import time
 import redis
+from telemetry import telemetry_publisher
 #import pyserial
 
 class tiptilt:
 
-    def __init__(self, base_directory, config_file, logger=None, simulate=False):
+    def __init__(self, base_directory, config_file, logger=None, simulate=False, telemetry=None):
         self.base_directory=base_directory
         self.config_file = self.base_directory + '/config/' + config_file
 
@@ -32,8 +33,11 @@ class tiptilt:
             self.logger.error('Config file not found: (' + self.config_file + ')')
             sys.exit()
 
-        self.redis = redis.Redis(host=config['REDIS_SERVER'],
-                                 port=config['REDIS_PORT'])
+        # the position goes to redis in the background, so moves never wait on it
+        if telemetry == None:
+            telemetry = telemetry_publisher(self.logger, redis.Redis(host=config['REDIS_SERVER'],
+                                                                     port=config['REDIS_PORT']))
+        self.telemetry = telemetry
             
         # serial number of the TIP/TILT stage and controller
         self.sn = config['SN_TIPTILT']
@@ -141,8 +145,7 @@ class tiptilt:
         self.position['A'] = tip
         self.position['B'] = tilt
 
-        self.redis.set('tip',tip)
-        self.redis.set('tilt',tilt)
+        self.telemetry.update({'tip':tip,'tilt':tilt})
         
         # wait for move?
         
@@ -0,0 +1,61 @@
+import numpy as np
+from collections import deque
+
+''' 
+predicts where the guide star will be in the next frame, so only a small
+stamp there needs to be centroided (see imager.track_star)
+the prediction is the last position, plus the drift measured from the recent
+positions (after removing the tip/tilt corrections), plus the tip/tilt
+corrections commanded since the last position
+times are time.monotonic(); positions are detector pixels
+history - the number of recent positions used to measure the drift
+max_misses - after this many consecutive frames without the star, it is lost
+             (and the guide loop must find it in the full frame again)
+'''
+class star_tracker:
+
+    def __init__(self, history=5, max_misses=2):
+        self.history = history
+        self.max_misses = max_misses
+        self.reset()
+
+    # forget the star
+    def reset(self):
+        # (time, x, y) with the cumulative correction removed
+        self.positions = deque(maxlen=self.history)
+        self.correction = np.zeros(2)
+        self.misses = 0
+
+    # do we know where the star is?
+    def locked(self):
+        return len(self.positions) > 0 and self.misses < self.max_misses
+
+    # the star was measured at (x,y) at time t
+    def update(self, t, x, y):
+        self.positions.append((t, x-self.correction[0], y-self.correction[1]))
+        self.misses = 0
+
+    # the star wasn't found where predicted
+    def miss(self):
+        self.misses += 1
+        if self.misses >= self.max_misses: self.reset()
+
+    # the tip/tilt was commanded to move the star by (dx,dy) pixels
+    def add_correction(self, dx, dy):
+        self.correction[0] += dx
+        self.correction[1] += dy
+
+    # the drift of the star (pixels/s), excluding tip/tilt corrections
+    def drift(self):
+        if len(self.positions) < 2: return np.zeros(2)
+        t,x,y = np.array(self.positions).T
+        t = t - t[-1]
+        if np.ptp(t) <= 0.0: return np.zeros(2)
+        return np.array([np.polyfit(t, x, 1)[0], np.polyfit(t, y, 1)[0]])
+
+    # where the star should be at time t
+    def predict(self, t):
+        tlast,x,y = self.positions[-1]
+        vx,vy = self.drift()
+        return (x + vx*(t-tlast) + self.correction[0],
+                y + vy*(t-tlast) + self.correction[1])
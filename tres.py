@@ -17,9 +17,14 @@ from guider import imager
 from calstage import calstage
 from tiptilt import tiptilt
 from pdu import pdu
+from tracking import star_tracker
+from ensemble import match_stars, solve_transform, apply_transform
+from pipeline import latest_queue, correction_log
+import queue
 import redis
+from telemetry import telemetry_publisher
 import json
-import pyds9
+from display import display_publisher
 
 class tres:
 
@@ -49,14 +54,40 @@ class tres:
 #        self.redis.set('state','Starting')
 #        self.redis.set('errors','None')
             
+        # sends telemetry to redis in the background (see telemetry.telemetry_publisher)
+        self.telemetry = telemetry_publisher(self.logger, redis.StrictRedis(host=config['REDIS_SERVER'],
+                                                                            port=config['REDIS_PORT']))
+
         # set up the devices
         self.guider = imager(base_directory, 'zyla.ini', logger=self.logger, simulate=guider_simulate)
-        self.calstage = calstage(base_directory, 'calstage.ini', logger=self.logger, simulate=calstage_simulate)
-        self.tiptilt = tiptilt(base_directory, 'tiptilt.ini', logger=self.logger, simulate=tiptilt_simulate)
+        self.calstage = calstage(base_directory, 'calstage.ini', logger=self.logger, simulate=calstage_simulate,
+                                 on_move=self.refresh_device_state)
+        self.tiptilt = tiptilt(base_directory, 'tiptilt.ini', logger=self.logger, simulate=tiptilt_simulate,
+                               telemetry=self.telemetry)
         
         # connect the devices
         self.tiptilt.connect()
         self.calstage.connect()
+
+        # the header is a template made once, plus the state of the devices.
+        # While guiding, the state is refreshed in the background so saving
+        # images never waits on the controllers; otherwise it's queried when
+        # the header is made (see get_header)
+        self.header_template = None
+        self.device_state = {}
+        self.device_state_lock = threading.Lock()
+        self.state_interval = float(config.get('STATE_INTERVAL',5.0))
+        state_thread = threading.Thread(target=self.refresh_device_state_loop)
+        state_thread.name = 'device_state_thread'
+        state_thread.daemon = True
+        state_thread.start()
+
+        # shows the guider images (in DS9, when it's running) without slowing the guide loop
+        self.display = display_publisher(self.logger,
+                                         rate=float(config.get('DISPLAY_RATE',2.0)),
+                                         downsample=int(config.get('DISPLAY_DOWNSAMPLE',1)),
+                                         stretch=(str(config.get('DISPLAY_STRETCH','False')) == 'True'),
+                                         latency=self.guider.latency)
 #        self.redis.set('state','Initialized')
 #        self.redis.publish('tracking_data',json.dumps({'timestamp':datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.%f') ,'x_mispointing':0.0,'y_mispointing':0.0,'north_mispointing':0.0,'east_mispointing':0.0,'dx':0.0,'dy':0.0,'north':0.0,'east':0.0,'counts':0,'fwhm':1.0,'platescale':0.0,'roi_x1':0,'roi_x2':0,'roi_y1':0,'roi_y2':0}))
 
@@ -72,10 +103,26 @@ class tres:
     # simulate - Boolean. If true, will use a simulated stellar image
     # save - boolean. If true, it will save the guider images (and increase overhead)
     # subframe - Boolean. If true, it will use a 3*tolerance subframe to guide (decrease overhead). 
-    def guide(self, exptime, offset=(0.0,0.0), tolerance=10.0, simulate=False, save=False, subframe=True):
+    # track - Boolean. If true, once the star is found, only centroid a stamp where it is predicted to be
+    # ensemble - Boolean. If true, measure the guide star position from the shift of all the stars in the field
+    # rotation - Boolean. If true (and ensemble), fit a field rotation too
+    # match_tolerance - how far (arcsec) a star can be from its reference position to be used in the ensemble
+    # max_age - frames older than this (seconds after the exposure ended) by the time they could be centroided are dropped
+    # latency_file - where to dump the timing of each stage when guiding stops (.csv or .npy); default in the datapath
+    #
+    # the loop is pipelined: one thread takes images, this one centroids them
+    # and another sends the corrections, so exposure N+1 integrates while
+    # frame N is centroided and the correction from frame N-1 is sent.
+    # Stale frames are handled by:
+    #   1) the frame queue holds only the newest frame; if a new frame
+    #      arrives before the last was centroided, the old one is dropped
+    #   2) frames older than max_age by the time they're centroided are dropped
+    #   3) corrections that were sent after an exposure started are added to
+    #      the position measured in it (in proportion to how much of the
+    #      exposure came after them), so they aren't applied twice
+    # corrections are relative moves, so they are never dropped
+    def guide(self, exptime, offset=(0.0,0.0), tolerance=10.0, simulate=False, save=False, subframe=True, track=True, ensemble=False, rotation=False, match_tolerance=2.0, max_age=None, latency_file=None):
 
-        ds9 = pyds9.DS9()
-        
 #        self.redis.set('state','Guiding')
         # move to the middle of the range
         self.tiptilt.move_tip_tilt(1.0,1.0)
@@ -95,116 +142,268 @@ class tres:
         
         # TODO: pick guide star, move it to fiber via telescope (pre-load tip/tilt?)
         # requires TCS communication (current functionality requires observer to do this)
-        
-        # main loop
-        while self.guider.guiding:
-
-            # set the subframe
-            if subframe:
-                subframesize = int(round(1.5*tolerance/self.guider.platescale))
-                subframesize = int(round(5*tolerance/self.guider.platescale))
-                if (subframesize % 2) == 1: subframesize +=1 # make sure it's even
-                x1 = int(round(self.guider.x_science_fiber + offset[0] - subframesize))
-                x2 = int(round(self.guider.x_science_fiber + offset[0] + subframesize))
-                y1 = int(round(self.guider.y_science_fiber + offset[1] - subframesize))
-                y2 = int(round(self.guider.y_science_fiber + offset[1] + subframesize))
-                self.guider.set_roi(x1,x2,y1,y2)
-            
-            if simulate:
-                t0 = datetime.datetime.utcnow()
-                xstar = int(round(self.guider.x_science_fiber + np.random.uniform(low=-1.0,high=1.0)))
-                ystar = int(round(self.guider.y_science_fiber + np.random.uniform(low=-1.0,high=1.0)))
-                self.guider.simulate_star_image([xstar],[ystar],[1e6], 1.5, noise=10.0)
-                elapsed_time = (datetime.datetime.utcnow()-t0).total_seconds()
-            else:
-                # expose while we get the header info
-                expose_thread = threading.Thread(target=self.guider.take_image, args=(exptime,))
-                expose_thread.name = 'guider_expose_thread'
-                expose_thread.start()
-
-            # get the header info
-            if save: hdr = self.get_header()
-            
-            # wait for the exposure to complete
-            if simulate:
-                if elapsed_time < exptime:
-                    time.sleep(exptime-elapsed_time)
-            else: expose_thread.join()
-
-            ds9.set_np2arr(self.guider.image)
-            # ****** JUST FOR DEBUGGING ******
-            #time.sleep(10)
-            
-            # save the image
-            if save:
-                objname = 'test'
-                files = glob.glob(self.guider.datapath + "*.fits")
-                index = str(len(files)+1).zfill(4)
-                datestr = datetime.datetime.utcnow().strftime('%y%m%d') 
-                filename = self.guider.datapath + objname + '.' + datestr + '.guider.' + index + '.fits'
-
-                # saving can go on in the background
-                kwargs={'hdr':hdr}
-                save_image_thread = threading.Thread(target=self.guider.save_image,args=(filename,),kwargs=kwargs)
-                save_image_thread.name = 'save_image_thread'
-                save_image_thread.start()
-                
-                #self.guider.save_image(filename, hdr=hdr)
 
-            self.logger.info("Finding stars")
-            stars = self.guider.get_stars()
+        # predicts where the guide star will be
+        tracker = star_tracker()
+
+        # with ensemble guiding, every star in the field measures the shift
+        # from the first frame, and the guide star position comes from that
+        # shift (full frame detections, so tracking a stamp is disabled)
+        reference = None
+        if ensemble: track = False
+
+        # set the subframe (it doesn't change while guiding)
+        if subframe:
+            subframesize = int(round(1.5*tolerance/self.guider.platescale))
+            subframesize = int(round(5*tolerance/self.guider.platescale))
+            if (subframesize % 2) == 1: subframesize +=1 # make sure it's even
+            x1 = int(round(self.guider.x_science_fiber + offset[0] - subframesize))
+            x2 = int(round(self.guider.x_science_fiber + offset[0] + subframesize))
+            y1 = int(round(self.guider.y_science_fiber + offset[1] - subframesize))
+            y2 = int(round(self.guider.y_science_fiber + offset[1] + subframesize))
+            self.guider.set_roi(x1,x2,y1,y2)
+
+        # the state of the devices as guiding starts (the cal stage may have moved)
+        self.refresh_device_state()
+
+        # share the frames with other processes
+        self.guider.open_frame_bus()
+
+        # how accurate each centroider is vs. SNR (once)
+        if self.guider.scheduler.accuracy == None: self.guider.scheduler.calibrate()
+
+        # start the acquisition and actuator stages
+        if max_age == None: max_age = 2.0*exptime + 1.0
+        frames = latest_queue(maxsize=1)
+        corrections = queue.Queue(maxsize=4)
+        correction_history = correction_log()
+        acquire_thread = threading.Thread(target=self.acquire_frames, args=(exptime, frames),
+                                          kwargs={'simulate':simulate, 'save':save})
+        acquire_thread.name = 'guider_acquire_thread'
+        acquire_thread.start()
+        actuate_thread = threading.Thread(target=self.send_corrections, args=(corrections, correction_history))
+        actuate_thread.name = 'tiptilt_actuate_thread'
+        actuate_thread.start()
+
+        # main loop (the centroid stage). However it stops, stop the other
+        # stages too, so the camera doesn't keep streaming and the actuator
+        # isn't left waiting for corrections
+        nstale = 0
+        try:
+            while self.guider.guiding:
+
+                frame = frames.get(timeout=1.0)
+                if frame == None: continue
+                tframe = 0.5*(frame['tstart'] + frame['tend'])
+
+                if (time.monotonic() - frame['tend']) > max_age:
+                    nstale += 1
+                    self.logger.warning("Frame is " + str(time.monotonic() - frame['tend']) +
+                                        " seconds old; dropping it (" + str(nstale) + " stale, " +
+                                        str(frames.dropped) + " superseded)")
+                    self.guider.release_frame(frame)
+                    continue
+
+                self.guider.load_frame(frame)
+
+                self.display.publish(self.guider.image, frame['number'])
+                # ****** JUST FOR DEBUGGING ******
+                #time.sleep(10)
+            
+                # save the image
+                if save:
+                    objname = 'test'
+                    datestr = datetime.datetime.utcnow().strftime('%y%m%d') 
+                    index = str(self.guider.frame_index.next(objname, datestr)).zfill(4)
+                    filename = self.guider.datapath + objname + '.' + datestr + '.guider.' + index + '.fits'
+
+                    # saving goes on in the background (the guide loop never waits on the disk)
+                    self.guider.save_frame(filename, frame, hdr=frame['hdr'])
+
+                # the centroid should be done before the next frame is read out
+                deadline = frame['tend']+exptime
+
+                # the corrections this frame doesn't include yet
+                pending = correction_history.pending(frame['tstart'], frame['tend'])
+
+                # once we have the star, just centroid a stamp where it should be
+                stars = []
+                if track and tracker.locked():
+                    xpredict,ypredict = tracker.predict(tframe) - pending
+                    stars = self.guider.track_star(xpredict, ypredict, deadline=deadline)
+                    if len(stars) == 0 or math.hypot(stars[0,0]-xpredict,stars[0,1]-ypredict) > self.guider.stampsize/4.0:
+                        self.logger.warning("Guide star not at the predicted position (" + str(xpredict) + ',' +
+                                            str(ypredict) + '); searching the full frame')
+                        tracker.miss()
+                        stars = []
+
+                if len(stars) == 0:
+                    self.logger.info("Finding stars")
+                    stars = self.guider.get_stars(deadline=deadline,
+                                                  target=(self.guider.x_science_fiber-offset[0]-pending[0],
+                                                          self.guider.y_science_fiber-offset[1]-pending[1]))
            
-            if len(stars) == 0:
-                self.logger.warning("No guide stars in image; skipping correction")
-                if save: save_image_thread.join()
-                continue
-
-            # find the closest star to the desired position                            
-            dx = stars[:,0] - (self.guider.x_science_fiber-offset[0])
-            dy = stars[:,1] - (self.guider.y_science_fiber-offset[1])
-            dist = np.sqrt(dx*dx + dy*dy)*self.guider.platescale
-            ndx = np.argmin(dist)
-            self.logger.info("Using guide star (" + str(stars[ndx,0]) + ',' +
-                             str(stars[ndx,1]) + ') ' + str(dist[ndx]) +
-                             ' arcsec (' + str(dist[ndx]/self.guider.platescale) +
-                             ' pixels) from the requested position (' +
-                             str(self.guider.x_science_fiber-offset[0]) + ',' +
-                             str(self.guider.y_science_fiber-offset[1]) + ')')
-
-            # if the star disappears, don't correct to a different star
-            # magnitude tolerance, too? (probably not -- clouds could cause trouble)
-            if dist[ndx] < tolerance:
-                p.setPoint((self.guider.x_science_fiber+offset[0],self.guider.y_science_fiber+offset[1]))
-
-                # calculate the X & Y pixel offsets
-                dx,dy = p.update(np.array([stars[ndx,0],stars[ndx,1]]))
+                if len(stars) == 0:
+                    self.logger.warning("No guide stars in image; skipping correction")
+                    tracker.reset()
+                    continue
+
+                # where the stars are now
+                stars[:,0] += pending[0]
+                stars[:,1] += pending[1]
+
+                # find the closest star to the desired position                            
+                dx = stars[:,0] - (self.guider.x_science_fiber-offset[0])
+                dy = stars[:,1] - (self.guider.y_science_fiber-offset[1])
+                dist = np.sqrt(dx*dx + dy*dy)*self.guider.platescale
+                ndx = np.argmin(dist)
+                self.logger.info("Using guide star (" + str(stars[ndx,0]) + ',' +
+                                 str(stars[ndx,1]) + ') ' + str(dist[ndx]) +
+                                 ' arcsec (' + str(dist[ndx]/self.guider.platescale) +
+                                 ' pixels) from the requested position (' +
+                                 str(self.guider.x_science_fiber-offset[0]) + ',' +
+                                 str(self.guider.y_science_fiber-offset[1]) + ')')
+
+                if ensemble and dist[ndx] < tolerance:
+                    if reference is None:
+                        reference = stars.copy()
+                        guide_reference = stars[ndx,0:2].copy()
+                    else:
+                        star_ndx, ref_ndx = match_stars(stars, reference, match_tolerance/self.guider.platescale,
+                                                        initial=stars[ndx,0:2]-guide_reference)
+                        transform = None
+                        if len(star_ndx) >= 2:
+                            transform = solve_transform(stars[star_ndx], reference[ref_ndx], rotation=rotation)
+                        if transform is None or transform[5] < 2:
+                            self.logger.warning("Too few stars matched to the reference (" + str(len(star_ndx)) +
+                                                "); using the guide star alone")
+                        else:
+                            stars[ndx,0],stars[ndx,1] = apply_transform(transform, guide_reference[0], guide_reference[1])
+                            self.logger.info("Ensemble of " + str(transform[5]) + " stars puts the guide star at (" +
+                                             str(stars[ndx,0]) + ',' + str(stars[ndx,1]) + '), rotation ' +
+                                             str(transform[2]) + ' radians, rms ' + str(transform[6]) + ' pixels')
+
+                # if the star disappears, don't correct to a different star
+                # magnitude tolerance, too? (probably not -- clouds could cause trouble)
+                if dist[ndx] < tolerance:
+                    tracker.update(tframe, stars[ndx,0], stars[ndx,1])
+                    p.setPoint((self.guider.x_science_fiber+offset[0],self.guider.y_science_fiber+offset[1]))
+
+                    # calculate the X & Y pixel offsets
+                    with self.guider.latency.timer(frame['number'], 'pid'):
+                        dx,dy = p.update(np.array([stars[ndx,0],stars[ndx,1]]))
                 
-                # convert X & Y pixel to North & East arcsec offset
-                # don't need cos(dec) term unless we send via mount
-                PA = 0.0 # get from Telescope? Config file? user?
+                    # convert X & Y pixel to North & East arcsec offset
+                    # don't need cos(dec) term unless we send via mount
+                    PA = 0.0 # get from Telescope? Config file? user?
 
-                north_mispointing = self.guider.platescale*(stars[ndx,0]*math.cos(PA) - stars[ndx,1]*math.sin(PA))
-                east_mispointing  = self.guider.platescale*(stars[ndx,0]*math.sin(PA) + stars[ndx,1]*math.cos(PA))
+                    north_mispointing = self.guider.platescale*(stars[ndx,0]*math.cos(PA) - stars[ndx,1]*math.sin(PA))
+                    east_mispointing  = self.guider.platescale*(stars[ndx,0]*math.sin(PA) + stars[ndx,1]*math.cos(PA))
                 
-                north = self.guider.platescale*(dx*math.cos(PA) - dy*math.sin(PA))
-                east  = self.guider.platescale*(dx*math.sin(PA) + dy*math.cos(PA))
-
-#                self.redis.publish('tracking_data',json.dumps({'timestamp':datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.%f'),'x_mispointing':stars[ndx,0],'y_mispointing':stars[ndx,1],'north_mispointing':north_mispointing,'east_mispointing':east_mispointing,'dx':dx,'dy':dy,'north':north,'east':east,'counts':stars[ndx,2],'fwhm':1.0+np.random.uniform(low=-0.1,high=0.1),'platescale':self.guider.platescale,'roi_x1':x1,'roi_x2':x2,'roi_y1':y1,'roi_y2':y2}))
+                    north = self.guider.platescale*(dx*math.cos(PA) - dy*math.sin(PA))
+                    east  = self.guider.platescale*(dx*math.sin(PA) + dy*math.cos(PA))
+
+                    # one message per frame, sent in the background
+                    tracking_data = {'timestamp':frame['dateobs'].strftime('%Y-%m-%dT%H:%M:%S.%f'),
+                                     'frame':frame['number'],
+                                     'x_mispointing':float(stars[ndx,0]),'y_mispointing':float(stars[ndx,1]),
+                                     'north_mispointing':float(north_mispointing),'east_mispointing':float(east_mispointing),
+                                     'dx':float(dx),'dy':float(dy),'north':float(north),'east':float(east),
+                                     'counts':float(stars[ndx,2]),'fwhm':1.0,'platescale':self.guider.platescale,
+                                     'roi_x1':self.guider.x1,'roi_x2':self.guider.x2,
+                                     'roi_y1':self.guider.y1,'roi_y2':self.guider.y2,
+                                     'frames_superseded':frames.dropped,'frames_stale':nstale}
+                    tracking_data.update(self.guider.writer.stats())
+                    self.telemetry.publish('tracking_data', tracking_data)
                 
-                # TODO: make sure the move is within range
-                move_in_range = True
+                    # TODO: make sure the move is within range
+                    move_in_range = True
                 
-                # send correction to tip/tilt
-                if move_in_range:
-                    self.logger.info("Moving tip/tilt " + str(dx) + ' pixels in X, ' + str(dy) + ' pixels in Y')
-                    self.tiptilt.move_x_y(dx,dy)
+                    # send correction to tip/tilt (in the actuator thread)
+                    if move_in_range:
+                        self.logger.info("Moving tip/tilt " + str(dx) + ' pixels in X, ' + str(dy) + ' pixels in Y')
+                        corrections.put((frame['number'], correction_history.issued(dx,dy)))
+                        tracker.add_correction(dx,dy)
+                    else:
+                        # TODO: move telescope, recenter tip/tilt
+                        self.logger.error("Tip/tilt out of range. Must manually recenter")
                 else:
-                    # TODO: move telescope, recenter tip/tilt
-                    self.logger.error("Tip/tilt out of range. Must manually recenter")
-            else: self.logger.warning("Guide star too far away; skipping correction")
+                    self.logger.warning("Guide star too far away; skipping correction")
+                    tracker.reset()
                     
-            # make sure the image is saved first
-            if save: save_image_thread.join()
+        finally:
+            self.guider.guiding = False
+            corrections.put(None)
+            acquire_thread.join()
+            actuate_thread.join()
+
+        self.logger.info("Guiding stopped; dropped " + str(frames.dropped) + " superseded and " +
+                         str(nstale) + " stale frames")
+
+        # make sure the images are on disk before we return
+        self.guider.writer.flush()
+        self.logger.info("FITS writer: " + str(self.guider.writer.stats()))
+
+        # where the time went
+        for stage,percentiles in self.guider.latency.summary().items():
+            self.logger.info(stage + " took " + str(percentiles) + " seconds (50th, 90th, 99th percentile)")
+        self.logger.info("From exposure to correction took " + str(self.guider.latency.frame_percentiles()) +
+                         " seconds (50th, 90th, 99th percentile)")
+        if latency_file == None:
+            latency_file = self.guider.datapath + 'guider.' + datetime.datetime.utcnow().strftime('%y%m%d') + '.latency.csv'
+        self.guider.latency.dump(latency_file)
+
+    # the acquisition stage of the guide loop: take images and hand them to
+    # the centroid stage through frames (a latest_queue) until guiding stops
+    def acquire_frames(self, exptime, frames, simulate=False, save=False):
+
+        try:
+            # expose continuously instead of starting each exposure
+            if not simulate: self.guider.start_streaming(exptime)
+            while self.guider.guiding:
+                hdr = None
+                if simulate:
+                    t0 = time.monotonic()
+                    xstar = int(round(self.guider.x_science_fiber + np.random.uniform(low=-1.0,high=1.0)))
+                    ystar = int(round(self.guider.y_science_fiber + np.random.uniform(low=-1.0,high=1.0)))
+                    frame = self.guider.simulate_frame([xstar],[ystar],[1e6], 1.5, noise=10.0)
+                    if save: hdr = self.get_header()
+                    elapsed_time = time.monotonic() - t0
+                    if elapsed_time < exptime:
+                        time.sleep(exptime-elapsed_time)
+                    frame['exptime'] = exptime
+                    frame['tend'] = time.monotonic()
+                    frame['tstart'] = frame['tend'] - exptime
+                    self.guider.latency.record(frame['number'], 'acquire', t0, frame['tend'])
+                else:
+                    # the camera keeps exposing while we get the header info
+                    if save: hdr = self.get_header()
+                    frame = self.guider.acquire_frame(exptime)
+
+                frame['hdr'] = hdr
+                if self.guider.frame_bus != None: self.guider.frame_bus.publish(frame)
+                old = frames.put(frame)
+                if old != None:
+                    self.logger.info("Centroiding is behind; dropped the previous frame")
+                    self.guider.release_frame(old)
+        except:
+            self.logger.exception("Error in the guider acquisition; stopping guiding")
+            self.guider.guiding = False
+        finally:
+            if not simulate: self.guider.stop_streaming()
+
+    # the actuator stage of the guide loop: send the corrections ((frame number,
+    # entry from correction_history.issued)) to the tip/tilt, until it gets None
+    def send_corrections(self, corrections, correction_history):
+        while True:
+            item = corrections.get()
+            if item == None: return
+            framenum,entry = item
+            t0 = time.monotonic()
+            try: self.tiptilt.move_x_y(entry[1],entry[2])
+            except: self.logger.exception("Error moving the tip/tilt")
+            correction_history.applied(entry, time.monotonic())
+            self.guider.latency.record(framenum, 'tiptilt', t0, entry[0])
 
     def take_image(self, filename, exptime, overwrite=False):
 
@@ -222,8 +421,48 @@ class tres:
         # save the image
         self.guider.save_image(filename, hdr=hdr, overwrite=overwrite)
         
+    # query the (slow) device state for the header
+    def refresh_device_state(self):
+        state = {'CSPOS':self.calstage.get_position_string(),
+                 'CSPOSN':self.calstage.get_position()}
+        with self.device_state_lock:
+            self.device_state = state
+
+    def refresh_device_state_loop(self):
+        while True:
+            time.sleep(self.state_interval)
+            if not self.guider.guiding: continue
+            try: self.refresh_device_state()
+            except: self.logger.exception("Error refreshing the device state")
+
+    # a copy of the header template, with the fields that change filled in
+    # from the device state (the last one, while guiding)
     def get_header(self):
 
+        if self.header_template is None: self.header_template = self.make_header_template()
+        hdr = self.header_template.copy()
+
+        if not self.guider.guiding: self.refresh_device_state()
+
+        with self.device_state_lock: state = self.device_state
+        hdr['CSPOS'] = (state['CSPOS'],"Position of the cal stage (string)")
+        hdr['CSPOSN'] = (state['CSPOSN'],"Position of the cal stage (mm)")
+
+        # the tip/tilt position is tracked in software, so it's current (and free)
+        ttpos = self.tiptilt.get_position()
+        hdr['TTTIPPOS'] = (ttpos['A'],"Tip Position of the tip/tilt stage (urad)")
+        hdr['TTTILPOS'] = (ttpos['B'],"Tilt Position of the tip/tilt stage (urad)")
+
+        hdr['XSCIFIB'] = (self.guider.x_science_fiber,'X pixel of science fiber centroid')
+        hdr['YSCIFIB'] = (self.guider.y_science_fiber,'Y pixel of science fiber centroid')
+        hdr['XSKYFIB'] = (self.guider.x_sky_fiber,'X pixel of sky fiber centroid')
+        hdr['YSKYFIB'] = (self.guider.y_sky_fiber,'Y pixel of sky fiber centroid')
+        hdr['GUIDSTAT'] = (self.guider.guidestatus,'Status of the guiding loop')
+        return hdr
+
+    # the header, with placeholders for everything that can change
+    def make_header_template(self):
+
         hdr = fits.Header()
 
         # placeholders might be wrong if we populated them now. let guider.save_image populate them
@@ -243,28 +482,27 @@ class tres:
         hdr['CCD-TEMP'] = (-999,'CCD Temperature (C)') # do we have this?
 
         # Calibration stage info
-        hdr['CSPOS'] = (self.calstage.get_position_string(),"Position of the cal stage (string)")
-        hdr['CSPOSN'] = (self.calstage.get_position(),"Position of the cal stage (mm)")
+        hdr['CSPOS'] = ('',"Position of the cal stage (string)") # placeholder
+        hdr['CSPOSN'] = ('',"Position of the cal stage (mm)") # placeholder
         hdr['CSMODEL'] = (self.calstage.model,"Model Number of the cal stage")
         hdr['CSSN'] = (self.calstage.sn,"Serial number of the calibration stage")
         hdr['CSCMODEL'] = (self.calstage.model_controller,"Model of the cal stage controller")
         hdr['CSCSN'] = (self.calstage.sn_controller,"Serial number of the cal stage controller")
 
         # Tip/Tilt stage info
-        ttpos = self.tiptilt.get_position()
-        hdr['TTTIPPOS'] = (ttpos['A'],"Tip Position of the tip/tilt stage (urad)")
-        hdr['TTTILPOS'] = (ttpos['B'],"Tilt Position of the tip/tilt stage (urad)")
+        hdr['TTTIPPOS'] = ('',"Tip Position of the tip/tilt stage (urad)") # placeholder
+        hdr['TTTILPOS'] = ('',"Tilt Position of the tip/tilt stage (urad)") # placeholder
         hdr['TTMODEL'] = (self.tiptilt.model,"Model number of the tip/tilt stage")
         hdr['TTSN'] = (self.tiptilt.sn,"Serial number of the tip/tilt stage")
         hdr['TTCMODEL'] = (self.tiptilt.model_controller,"Model number of the tip/tilt stage controller")
         hdr['TTCSN'] = (self.tiptilt.sn_controller,"Serial number of the tip/tilt stage controller")
 
         # Fiber info
-        hdr['XSCIFIB'] = (self.guider.x_science_fiber,'X pixel of science fiber centroid')
-        hdr['YSCIFIB'] = (self.guider.y_science_fiber,'Y pixel of science fiber centroid')
-        hdr['XSKYFIB'] = (self.guider.x_sky_fiber,'X pixel of sky fiber centroid')
-        hdr['YSKYFIB'] = (self.guider.y_sky_fiber,'Y pixel of sky fiber centroid')
-        hdr['GUIDSTAT'] = (self.guider.guidestatus,'Status of the guiding loop')
+        hdr['XSCIFIB'] = ('','X pixel of science fiber centroid') # placeholder
+        hdr['YSCIFIB'] = ('','Y pixel of science fiber centroid') # placeholder
+        hdr['XSKYFIB'] = ('','X pixel of sky fiber centroid') # placeholder
+        hdr['YSKYFIB'] = ('','Y pixel of sky fiber centroid') # placeholder
+        hdr['GUIDSTAT'] = ('','Status of the guiding loop') # placeholder
 
         # telescope information (requires communication with TCS)
         #hdr['SITELAT'] = (latitude,"Site Latitude (deg)")
@@ -315,6 +553,13 @@ class tres:
         
         return hdr
 
+    # finish saving images and sending telemetry, and stop sharing frames
+    def shutdown(self):
+        self.guider.writer.close()
+        self.guider.frame_index.flush()
+        self.guider.close_frame_bus()
+        self.telemetry.flush()
+
     def test_guide_loop(self, exptime=0.1, simulate=False, save=False):
         self.guider.guiding=True
 
@@ -356,6 +601,7 @@ if __name__ == '__main__':
 
 
     tres.test_guide_loop(simulate=simulate, save=True, exptime=0.02)
+    tres.shutdown()
 
     if apc.starprojector.status():
         apc.starprojector.off()
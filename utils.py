@@ -3,6 +3,7 @@ import os
 import logging
 import subprocess
 import ipdb
+import numpy as np
 
 def setup_logger(path, logger_name):
 
@@ -36,6 +37,42 @@ def setup_logger(path, logger_name):
     return logger
     
     
+# the median, quartiles, and std of the pixels within the 1.5*IQR fences of the
+# quartiles of an image, in linear time (no full sort): from a histogram for
+# 8/16 bit integer images, or np.partition otherwise. Returns (median, q1, q3, std)
+# step - only use every step-th pixel (along each axis)
+def robust_stats(x, step=1):
+
+    if step > 1: x = x[(slice(None,None,step),)*x.ndim]
+    y = x.ravel()
+    n = len(y)
+    ind_qt1 = min(int(round((n+1)/4.)), n-1)
+    ind_qt3 = min(int(round((n+1)*3/4.)), n-1)
+    ind_med1 = (n-1)//2
+    ind_med2 = n//2
+
+    if y.dtype == np.uint8 or y.dtype == np.uint16:
+        counts = np.bincount(y)
+        cumulative = np.cumsum(counts)
+        # the value of the k-th smallest pixel
+        q1,q3,med1,med2 = np.searchsorted(cumulative, np.array([ind_qt1,ind_qt3,ind_med1,ind_med2])+1)
+        IQR = float(q3) - float(q1)
+        values = np.arange(len(counts), dtype=np.float64)
+        ok = (values > q1 - 1.5*IQR) & (values < q3 + 1.5*IQR)
+        counts = counts[ok]
+        values = values[ok]
+        npix = np.sum(counts)
+        mean = np.dot(counts,values)/npix
+        std = np.sqrt(np.dot(counts,(values-mean)**2)/npix)
+    else:
+        y = np.partition(y, [ind_qt1,ind_med1,ind_med2,ind_qt3])
+        q1,q3,med1,med2 = y[ind_qt1],y[ind_qt3],y[ind_med1],y[ind_med2]
+        IQR = q3 - q1
+        ok = (y > q1 - 1.5*IQR) & (y < q3 + 1.5*IQR)
+        std = y[ok].std(dtype='double')
+
+    return ((float(med1)+float(med2))/2.0, float(q1), float(q3), float(std))
+
 def dateobs2jd(dateobs):
     t0 = datetime.datetime(2000,1,1)
     t0jd = 2451544.5